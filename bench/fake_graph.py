@@ -0,0 +1,456 @@
+"""A local stand-in for the parts of Microsoft Graph these scripts use.
+
+Serves To Do lists, tasks (with ``$expand=checklistItems`` and delta),
+checklist items, JSON ``$batch``, and a OneDrive tree (children, item,
+content with ``Range``, root delta) from a synthetic dataset.  Items are
+generated from their index on demand, so a million tasks cost no memory
+until something is created, changed or deleted.
+
+    python fake_graph.py --port 8765 --lists 100 --tasks-per-list 1000 --latency 20
+    export GRAPH_ROOT=http://127.0.0.1:8765/v1.0
+
+With ``--port 0`` a free port is picked; the first line printed is always
+``listening on <port>``.  ``GET /_stats`` returns request counts.
+"""
+import argparse
+import functools
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+MODIFIED = "2024-01-01T00:00:00Z"
+
+
+class Tasks:
+    """One list's tasks: ``count`` generated ones plus whatever was created later."""
+
+    def __init__(self, list_id, count):
+        self.list_id = list_id
+        self.count = count
+        self.created = []
+        self.patched = {}
+        self.deleted = set()
+
+    def __len__(self):
+        return self.count + len(self.created)
+
+    def get(self, index):
+        if index < self.count:
+            task_id = f"{self.list_id}-task-{index}"
+            if task_id in self.deleted:
+                return None
+            task = self.patched.get(task_id)
+            if task is None:
+                task = {
+                    "id": task_id,
+                    "title": f"Task {index}",
+                    "status": "completed" if index % 3 == 0 else "notStarted",
+                    "importance": "normal",
+                    "body": {"content": f"Generated task {index}", "contentType": "text"},
+                    "lastModifiedDateTime": MODIFIED,
+                }
+            return task
+        task = self.created[index - self.count]
+        return None if task["id"] in self.deleted else self.patched.get(task["id"], task)
+
+    def page(self, skip, top):
+        tasks = (self.get(i) for i in range(skip, min(skip + top, len(self))))
+        return [task for task in tasks if task is not None]
+
+    def find(self, task_id):
+        match = re.fullmatch(re.escape(self.list_id) + r"-task-(\d+)", task_id)
+        if match and int(match[1]) < self.count:
+            return self.get(int(match[1]))
+        for task in self.created:
+            if task["id"] == task_id and task_id not in self.deleted:
+                return self.patched.get(task_id, task)
+        return None
+
+
+class Dataset:
+    def __init__(self, args):
+        self.lock = threading.Lock()
+        self.ids = iter(range(1, sys.maxsize))
+        self.lists = [{"id": f"list-{i}", "displayName": f"List {i}", "isOwner": True,
+                       "isShared": False, "wellknownListName": "none"} for i in range(args.lists)]
+        self.tasks = {l["id"]: Tasks(l["id"], args.tasks_per_list) for l in self.lists}
+        self.steps_per_task = args.steps_per_task
+        self.created_steps = {}
+        # (sequence, list id, task or removal) for task delta queries
+        self.changes = []
+
+        self.folders = args.folders
+        self.fanout = max(1, args.fanout)
+        self.files = args.files
+        self.file_size = args.file_size
+        # Files share content when there are fewer distinct contents than files.
+        self.distinct = max(1, round(args.files * (1 - args.dup_ratio)))
+
+    def new_id(self, prefix):
+        return f"{prefix}-{next(self.ids)}"
+
+    # To Do
+
+    def steps(self, task_id):
+        generated = [{"id": f"{task_id}-step-{k}", "displayName": f"Step {k}", "isChecked": k % 2 == 0}
+                     for k in range(self.steps_per_task)] if "-task-" in task_id else []
+        return generated + self.created_steps.get(task_id, [])
+
+    def record_change(self, list_id, task):
+        self.changes.append((list_id, task))
+
+    # OneDrive: index 0 is the root, 1..folders are folders, files follow.
+
+    def folder_id(self, index):
+        return "root" if index == 0 else f"folder-{index}"
+
+    def folder_children(self, index):
+        """Ids of the folder's children: subfolders first, then files."""
+        first = index * self.fanout + 1
+        subfolders = [f"folder-{k}" for k in range(first, min(first + self.fanout, self.folders + 1))]
+        files = [f"file-{m}" for m in range(index, self.files, self.folders + 1)]
+        return subfolders + files
+
+    def drive_item(self, item_id):
+        if item_id == "root":
+            return {"id": "root", "name": "root", "root": {}, "folder": {}, "parentReference": {},
+                    "lastModifiedDateTime": MODIFIED}
+        kind, _, number = item_id.partition("-")
+        index = int(number)
+        if kind == "folder" and 1 <= index <= self.folders:
+            parent = (index - 1) // self.fanout
+            return {"id": item_id, "name": f"dir{index}", "folder": {},
+                    "parentReference": {"id": self.folder_id(parent)}, "lastModifiedDateTime": MODIFIED}
+        if kind == "file" and 0 <= index < self.files:
+            content = index % self.distinct
+            return {"id": item_id, "name": f"file{index}.bin", "size": self.file_size,
+                    "file": {"hashes": {"sha1Hash": self.content_hash(content)}},
+                    "parentReference": {"id": self.folder_id(index % (self.folders + 1))},
+                    "lastModifiedDateTime": MODIFIED}
+        return None
+
+    def content(self, item_id, start, end):
+        index = int(item_id.partition("-")[2])
+        block = hashlib.sha256(str(index % self.distinct).encode()).digest()
+        data = (block * (self.file_size // len(block) + 1))[:self.file_size]
+        return data[start:end + 1]
+
+    @functools.lru_cache(maxsize=65536)
+    def content_hash(self, content):
+        block = hashlib.sha256(str(content).encode()).digest()
+        data = (block * (self.file_size // len(block) + 1))[:self.file_size]
+        return hashlib.sha1(data).hexdigest().upper()
+
+    def drive_sequence(self, index):
+        """The delta enumeration: root, folders, then files (parents always first)."""
+        if index == 0:
+            return "root"
+        if index <= self.folders:
+            return f"folder-{index}"
+        return f"file-{index - self.folders - 1}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeGraph/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    # plumbing
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def throttled(self):
+        options = self.server.options
+        return options.throttle_rate and self.server.random() < options.throttle_rate
+
+    def handle_call(self, method):
+        options = self.server.options
+        self.server.count(method)
+        if options.latency:
+            time.sleep(options.latency / 1000 * (0.5 + self.server.random()))
+        # Read the body even for a throttled call: left unread on a keep-alive
+        # connection, it would be parsed as the next request.
+        body = self.read_body() if method in ("POST", "PATCH") else None
+        if self.throttled():
+            self.server.count("throttled")
+            return self.send_json(429, {"error": {"code": "TooManyRequests"}},
+                                  {"Retry-After": str(options.retry_after)})
+        url = urlparse(self.path)
+        if method == "POST" and url.path.endswith("/$batch"):
+            return self.send_json(200, self.batch(body))
+        if method == "GET" and url.path == "/_stats":
+            return self.send_json(200, self.server.stats)
+        if method == "GET" and re.fullmatch(r"/v1\.0/me/drive/items/[^/]+/content", url.path):
+            return self.send_content(url.path.split("/")[-2])
+        status, result = self.route(method, url.path, parse_qs(url.query), body)
+        if status == 204:
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json(status, result)
+
+    def do_GET(self):
+        self.handle_call("GET")
+
+    def do_POST(self):
+        self.handle_call("POST")
+
+    def do_PATCH(self):
+        self.handle_call("PATCH")
+
+    def do_DELETE(self):
+        self.handle_call("DELETE")
+
+    # paging
+
+    def page(self, path, query, total, fetch):
+        """Slice a collection by $top/$skip and add @odata.nextLink."""
+        options = self.server.options
+        top = min(int(query.get("$top", [options.page_size])[0]), options.max_page_size)
+        skip = int(query.get("$skip", ["0"])[0])
+        body = {"@odata.context": f"{self.root()}/$metadata#collection", "value": fetch(skip, top)}
+        if skip + top < total:
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query.update({"$top": top, "$skip": skip + top})
+            body["@odata.nextLink"] = f"{self.root()}{path}?{urlencode(next_query)}"
+        return body
+
+    def root(self):
+        return f"http://{self.headers['Host']}"
+
+    # routes
+
+    def route(self, method, path, query, body):
+        data = self.server.data
+        rel = path[len("/v1.0"):] if path.startswith("/v1.0/") else path
+        with data.lock:
+            if rel == "/me/todo/lists":
+                if method == "POST":
+                    todo_list = {"id": data.new_id("list-new"), "isOwner": True, "isShared": False,
+                                 "wellknownListName": "none", **body}
+                    data.lists.append(todo_list)
+                    data.tasks[todo_list["id"]] = Tasks(todo_list["id"], 0)
+                    return 201, todo_list
+                return 200, self.page(path, query, len(data.lists),
+                                      lambda skip, top: data.lists[skip:skip + top])
+
+            match = re.fullmatch(r"/me/todo/lists/([^/]+)/tasks(?:/(delta|[^/]+))?(/checklistItems)?", rel)
+            if match:
+                tasks = data.tasks.get(match[1])
+                if tasks is None:
+                    return 404, {"error": {"code": "ErrorItemNotFound"}}
+                if match[2] == "delta":
+                    return 200, self.task_delta(path, query, tasks)
+                if match[2] is None:
+                    return self.tasks(method, path, query, body, tasks)
+                task = tasks.find(match[2])
+                if task is None:
+                    return 404, {"error": {"code": "ErrorItemNotFound"}}
+                if match[3]:
+                    if method == "POST":
+                        step = {"id": data.new_id("step"), "isChecked": False, **body}
+                        data.created_steps.setdefault(task["id"], []).append(step)
+                        return 201, step
+                    steps = data.steps(task["id"])
+                    return 200, self.page(path, query, len(steps), lambda skip, top: steps[skip:skip + top])
+                if method == "PATCH":
+                    task = dict(task, **body)
+                    tasks.patched[task["id"]] = task
+                    data.record_change(tasks.list_id, task)
+                    return 200, task
+                if method == "DELETE":
+                    tasks.deleted.add(task["id"])
+                    data.record_change(tasks.list_id, {"id": task["id"], "@removed": {"reason": "deleted"}})
+                    return 204, None
+                return 200, task
+
+            if rel in ("/me/drive/root", "/me/drive/root/children") or rel.startswith("/me/drive/items/"):
+                return self.drive(path, rel, query)
+            if rel == "/me/drive/root/delta":
+                return 200, self.drive_delta(path, query)
+        return 404, {"error": {"code": "NotFound", "message": path}}
+
+    def tasks(self, method, path, query, body, tasks):
+        data = self.server.data
+        if method == "POST":
+            task = {"id": data.new_id(f"{tasks.list_id}-new"), "status": "notStarted",
+                    "lastModifiedDateTime": MODIFIED, **body}
+            tasks.created.append(task)
+            data.record_change(tasks.list_id, task)
+            return 201, task
+        expand = "checklistItems" in query.get("$expand", [""])[0]
+
+        def fetch(skip, top):
+            page = tasks.page(skip, top)
+            if expand:
+                page = [dict(task, checklistItems=data.steps(task["id"])) for task in page]
+            return page
+        return 200, self.page(path, query, len(tasks), fetch)
+
+    def task_delta(self, path, query, tasks):
+        data = self.server.data
+        token = query.get("$deltatoken", [None])[0]
+        link = f"{self.root()}{path}?$deltatoken={len(data.changes)}"
+        if token is None:
+            body = self.page(path, query, len(tasks), tasks.page)
+        else:
+            changes = [task for list_id, task in data.changes[int(token):] if list_id == tasks.list_id]
+            body = {"value": changes}
+        if "@odata.nextLink" not in body:
+            body["@odata.deltaLink"] = link
+        return body
+
+    def drive(self, path, rel, query):
+        data = self.server.data
+        match = re.fullmatch(r"/me/drive/(?:root|items/([^/]+))(/children)?", rel)
+        if not match:
+            return 404, {"error": {"code": "itemNotFound"}}
+        item_id = match[1] or "root"
+        item = data.drive_item(item_id)
+        if item is None:
+            return 404, {"error": {"code": "itemNotFound"}}
+        if not match[2]:
+            return 200, item
+        if "folder" not in item:
+            return 200, {"value": []}
+        index = 0 if item_id == "root" else int(item_id.partition("-")[2])
+        children = data.folder_children(index)
+        return 200, self.page(path, query, len(children),
+                              lambda skip, top: [data.drive_item(i) for i in children[skip:skip + top]])
+
+    def drive_delta(self, path, query):
+        data = self.server.data
+        if "token" in query:
+            # The synthetic drive never changes.
+            return {"value": [], "@odata.deltaLink": f"{self.root()}{path}?token=latest"}
+        total = 1 + data.folders + data.files
+        body = self.page(path, query, total,
+                         lambda skip, top: [data.drive_item(data.drive_sequence(i))
+                                            for i in range(skip, min(skip + top, total))])
+        if "@odata.nextLink" not in body:
+            body["@odata.deltaLink"] = f"{self.root()}{path}?token=latest"
+        return body
+
+    def send_content(self, item_id):
+        data = self.server.data
+        item = data.drive_item(item_id) if item_id.startswith("file-") else None
+        if item is None:
+            return self.send_json(404, {"error": {"code": "itemNotFound"}})
+        size = item["size"]
+        start, end, status = 0, size - 1, 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            if start >= size:
+                return self.send_json(416, {"error": {"code": "invalidRange"}})
+            status = 206
+        body = data.content(item_id, start, end)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def batch(self, body):
+        responses = []
+        status_by_id = {}
+        for request in body.get("requests", []):
+            depends = request.get("dependsOn") or []
+            if any(not 200 <= status_by_id.get(dep, 424) < 300 for dep in depends):
+                status, result = 424, {"error": {"code": "failedDependency"}}
+            elif self.throttled():
+                self.server.count("throttled")
+                responses.append({"id": request["id"], "status": 429,
+                                  "headers": {"Retry-After": str(self.server.options.retry_after)},
+                                  "body": {"error": {"code": "TooManyRequests"}}})
+                status_by_id[request["id"]] = 429
+                continue
+            else:
+                url = urlparse(request["url"])
+                status, result = self.route(request["method"], "/v1.0" + url.path,
+                                            parse_qs(url.query), request.get("body"))
+            status_by_id[request["id"]] = status
+            responses.append({"id": request["id"], "status": status, "body": result})
+        # Graph does not promise any order.
+        responses.reverse()
+        return {"responses": responses}
+
+
+class FakeGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options):
+        super().__init__(("127.0.0.1", options.port), Handler)
+        self.options = options
+        self.data = Dataset(options)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.rng = random.Random(options.seed)
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def random(self):
+        with self.stats_lock:
+            return self.rng.random()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic Microsoft Graph for local testing and benchmarks.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (0 picks a free one)")
+    parser.add_argument("--lists", type=int, default=10)
+    parser.add_argument("--tasks-per-list", type=int, default=100)
+    parser.add_argument("--steps-per-task", type=int, default=2)
+    parser.add_argument("--folders", type=int, default=50)
+    parser.add_argument("--fanout", type=int, default=5, help="Subfolders per folder")
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--file-size", type=int, default=4096, help="Bytes per file")
+    parser.add_argument("--dup-ratio", type=float, default=0.0, help="Share of files whose content repeats another file")
+    parser.add_argument("--page-size", type=int, default=10, help="Page size when the client sends no $top")
+    parser.add_argument("--max-page-size", type=int, default=100, help="Largest $top honoured")
+    parser.add_argument("--latency", type=float, default=0, help="Mean milliseconds added to every request")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    server = FakeGraphServer(options)
+    print(f"listening on {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Time the scripts end to end against the fake Graph server.
+
+Starts ``fake_graph.py`` on a free port, points every script at it with
+``GRAPH_ROOT``, runs each one in a scratch directory and prints how long it
+took and how many Graph calls it made (from the ``GRAPH_METRICS`` report
+each run writes).  A run only counts as ok if it exited cleanly, reported
+no failed items or errors, and got no 4xx other than throttling.
+
+    python run_bench.py --lists 100 --tasks-per-list 1000 --latency 20
+    python run_bench.py --only onedrive-sync --folders 2000 --files 100000 --json run.json
+
+Options not listed below are passed to the fake server (see
+``fake_graph.py --help``).
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+FAKE_SERVER = os.path.join(HERE, "fake_graph.py")
+
+# "Sent 12 batch requests for 240 items (3 failed)" and the like.
+FAILED_ITEMS = re.compile(r"\((\d+) failed\)")
+
+
+def script(*parts):
+    return os.path.join(REPO, *parts)
+
+
+# name -> (command, working directory under the scratch dir)
+BENCHMARKS = {
+    "export-json": ([script("import-export", "python", "imp-exp-todo.py"), "export", "export.json"], "todo"),
+    "export-ndjson": ([script("import-export", "python", "imp-exp-todo.py"), "export", "export.ndjson"], "todo"),
+    "import-ndjson": ([script("import-export", "python", "imp-exp-todo.py"), "import", "export.ndjson"], "todo"),
+    "clone": ([script("clone-list", "clone.py"), "export.ndjson", "List 0", "List 0 (clone)"], "todo"),
+    "clone-live": ([script("clone-list", "clone.py"), "--from-live", "List 1", "List 1 (clone)"], "todo"),
+    "reset": ([script("reset-list", "reset_todo_status.py"), "List 0"], "todo"),
+    "todo-importer": ([script("create-list-from-file", "todo-importer.py"), "-list_file", "Bench Import.xlsx"], "todo"),
+    "onedrive-sync": ([script("download-onedrive", "OneDrive_Download.py"), "-sync_all"], "onedrive"),
+}
+
+
+def start_server(server_args):
+    process = subprocess.Popen([sys.executable, FAKE_SERVER, "--port", "0"] + server_args,
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith("listening on "):
+        process.kill()
+        raise SystemExit(f"fake server did not start: {line!r}")
+    return process, int(line.split()[-1])
+
+
+def prepare(workdir, tasks, steps):
+    """Token files for every script, and the spreadsheet todo-importer reads."""
+    for sub in ("todo", "onedrive"):
+        os.makedirs(os.path.join(workdir, sub), exist_ok=True)
+        # Each script reads its token from a different file.
+        for name in ("token.txt", "token", ".token"):
+            with open(os.path.join(workdir, sub, name), "w") as f:
+                f.write("fake-token")
+    try:
+        import openpyxl
+    except ImportError:
+        return False
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for t in range(tasks):
+        for s in range(max(1, steps)):
+            sheet.append([f"Imported task {t}", f"Step {s}" if steps else None])
+    workbook.save(os.path.join(workdir, "todo", "Bench Import.xlsx"))
+    return True
+
+
+def run(name, command, cwd, env):
+    metrics_file = os.path.join(cwd, f"metrics-{name}.json")
+    env = dict(env, GRAPH_METRICS=metrics_file)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + command, cwd=cwd, env=env,
+                            stdin=subprocess.DEVNULL, capture_output=True, text=True, errors="replace")
+    seconds = time.perf_counter() - start
+    lines = result.stdout.splitlines()
+    outcome = {
+        "name": name,
+        "seconds": round(seconds, 3),
+        "exit_code": result.returncode,
+        "failed_items": sum(int(n) for n in FAILED_ITEMS.findall(result.stdout)),
+        "errors": sum(1 for line in lines if line.startswith("Error")),
+        "client_errors": 0,
+    }
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            report = json.load(f)
+        outcome["requests"] = sum(e["requests"] for e in report["endpoints"])
+        outcome["throttled"] = sum(e["throttled"] for e in report["endpoints"])
+        outcome["bytes"] = sum(e["bytes"] for e in report["endpoints"])
+        # 4xx answers other than throttling, direct or inside a $batch.
+        outcome["client_errors"] = (
+            sum(n for e in report["endpoints"] for status, n in e["statuses"].items() if _client_error(status))
+            + sum(s["count"] for s in report["batch_subrequests"] if _client_error(s["status"])))
+        outcome["metrics"] = report
+    outcome["ok"] = not (result.returncode or outcome["failed_items"] or outcome["errors"] or outcome["client_errors"])
+    if not outcome["ok"]:
+        outcome["stderr"] = result.stderr[-2000:]
+        outcome["error_lines"] = [line[:200] for line in lines if line.startswith("Error")][:20]
+    return outcome
+
+
+def _client_error(status):
+    return str(status).startswith("4") and str(status) != "429"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scripts against a local fake Graph server.")
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS),
+                        help="Run just this benchmark (repeatable); default is all, in order")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per benchmark; each gets a fresh scratch dir")
+    parser.add_argument("--json", help="Write the results, with each run's metrics, to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directories")
+    parser.add_argument("--importer-tasks", type=int, default=200, help="Rows of tasks in the todo-importer sheet")
+    args, server_args = parser.parse_known_args()
+
+    names = args.only or list(BENCHMARKS)
+    results = []
+    for attempt in range(args.repeat):
+        # A fresh server per round, so imports and clones start from the same data.
+        server, port = start_server(server_args)
+        workdir = tempfile.mkdtemp(prefix="graph-bench-")
+        try:
+            has_sheet = prepare(workdir, args.importer_tasks, 2)
+            env = dict(os.environ, GRAPH_ROOT=f"http://127.0.0.1:{port}/v1.0")
+            for name in names:
+                command, sub = BENCHMARKS[name]
+                if name == "todo-importer" and not has_sheet:
+                    print(f"{name:<16} skipped (openpyxl is not installed)")
+                    continue
+                outcome = run(name, command, os.path.join(workdir, sub), env)
+                outcome["round"] = attempt + 1
+                results.append(outcome)
+                status = "ok" if outcome["ok"] else "FAILED"
+                if outcome["exit_code"]:
+                    status += f" (exit {outcome['exit_code']})"
+                print(f"{name:<16} {outcome['seconds']:>9.2f}s  {outcome.get('requests', '-'):>8} requests  "
+                      f"{outcome.get('throttled', 0):>5} throttled  {outcome['failed_items']:>5} failed  "
+                      f"{outcome['client_errors']:>5} 4xx  {status}", flush=True)
+                if not outcome["ok"]:
+                    print("\n".join(outcome["error_lines"]), file=sys.stderr)
+                    print(outcome["stderr"], file=sys.stderr)
+        finally:
+            server.terminate()
+            server.wait()
+            if args.keep:
+                print(f"scratch directory: {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"server_args": server_args, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
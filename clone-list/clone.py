@@ -1,7 +1,25 @@
-import requests
 import json
 import argparse
-import copy
+import hashlib
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from graph_batch import MAX_BATCH_SIZE, BatchWriter
+from graph_client import GraphError, get_client
+from graph_metrics import metrics
+from import_journal import ImportJournal, step_kind, task_kind
+from todo_export import iter_records
+
+DEFAULT_CONCURRENCY = 4
+
+# Task and step fields --from-live copies; ids and timestamps are Graph's own.
+TASK_FIELDS = ("title", "status", "importance", "body", "dueDateTime", "startDateTime", "completedDateTime",
+               "reminderDateTime", "isReminderOn", "recurrence", "categories")
+STEP_FIELDS = ("displayName", "isChecked")
 
 def get_access_token():
     try:
@@ -12,83 +30,282 @@ def get_access_token():
         exit(1)
 
 def fetch_todo_lists(access_token):
-    url = "https://graph.microsoft.com/v1.0/me/todo/lists"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        lists = response.json()
-        for todo_list in lists.get("value", []):
-            list_id = todo_list["id"]
-            todo_list["tasks"] = fetch_tasks(access_token, list_id)
-        return lists
-    else:
-        print(f"Error fetching lists: {response.status_code}, {response.text}")
+    try:
+        pages = get_client(access_token).iter_pages("/me/todo/lists")
+        # Keep the first page's envelope (@odata.context) and fold the rest in.
+        lists = next(pages)
+        lists.pop("@odata.nextLink", None)
+        for page in pages:
+            lists["value"].extend(page.get("value", []))
+    except GraphError as e:
+        print(f"Error fetching lists: {e}")
         return None
+    for todo_list in lists.get("value", []):
+        list_id = todo_list["id"]
+        todo_list["tasks"] = fetch_tasks(access_token, list_id)
+    return lists
+
+def iter_tasks(access_token, list_id):
+    """Yield the tasks of a list page by page as they arrive."""
+    try:
+        yield from get_client(access_token).iter_items(f"/me/todo/lists/{list_id}/tasks")
+    except GraphError as e:
+        print(f"Error fetching tasks for list {list_id}: {e}")
 
 def fetch_tasks(access_token, list_id):
-    url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json().get("value", [])
-    else:
-        print(f"Error fetching tasks for list {list_id}: {response.status_code}, {response.text}")
-        return []
+    return list(iter_tasks(access_token, list_id))
+
+def clone_todo_list(access_token, filename, source_list_name, new_list_name, resume=False):
+    """Clone one list from a .json or line-delimited export.
 
-def clone_todo_list(access_token, filename, source_list_name, new_list_name):
-    with open(filename, "r", encoding="utf-8") as f:
-        todo_data = json.load(f)
+    The export is read record by record and tasks are queued as they are
+    read; reading stops at the end of the source list, and an indexed
+    export is read only where the source list is. Progress is
+    journaled in ``<filename>.clone.journal.db`` so ``resume`` can pick up
+    an interrupted clone without creating duplicates.
+    """
+    writer = BatchWriter(get_client(access_token))
+    journal = ImportJournal(f"{filename}.clone.journal.db", resume)
+    source_list_id = None
+    new_list = {}
     
-    cloned_list = None
-    for todo_list in todo_data.get("value", []):
-        if todo_list["displayName"] == source_list_name:
-            cloned_list = copy.deepcopy(todo_list)
-            break
+    def created(status, body):
+        if status == 201:
+            print(f"Cloned list created: {new_list_name}")
+            new_list["id"] = body["id"]
+            journal.record("list", f"{source_list_id}:{new_list_name}", body["id"])
+        else:
+            print(f"Error creating list {new_list_name}: {status}, {json.dumps(body)}")
     
-    if not cloned_list:
+    for record in iter_records(filename, lists=[source_list_name]):
+        if record["type"] == "list":
+            if source_list_id is not None:
+                # A list's tasks follow it, so the source list is done.
+                break
+            if record["data"]["displayName"] == source_list_name:
+                source_list_id = record["data"]["id"]
+                existing = journal.target("list", f"{source_list_id}:{new_list_name}")
+                if existing:
+                    new_list["id"] = existing
+                    continue
+                # Create new list in Microsoft To-Do
+                writer.add("POST", "/me/todo/lists", {"displayName": new_list_name}, callback=created)
+                writer.flush()
+                if "id" not in new_list:
+                    journal.close()
+                    return
+        elif record["type"] == "task" and record["list_id"] == source_list_id:
+            if journal.target(task_kind(new_list["id"]), record["data"]["id"]):
+                continue
+            # Copy tasks to new list
+            import_task(writer, new_list["id"], record["data"], journal)
+    
+    if source_list_id is None:
         print(f"Error: Source list '{source_list_name}' not found.")
+        journal.close()
         return
-    
-    # Create new list in Microsoft To-Do
-    url = "https://graph.microsoft.com/v1.0/me/todo/lists"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    payload = {"displayName": new_list_name}
-    response = requests.post(url, headers=headers, json=payload)
-    
-    if response.status_code == 201:
-        new_list_id = response.json()["id"]
-        print(f"Cloned list created: {new_list_name}")
-        
-        # Copy tasks to new list
-        for task in cloned_list.get("tasks", []):
-            import_task(access_token, new_list_id, task)
-    else:
-        print(f"Error creating list {new_list_name}: {response.status_code}, {response.text}")
+    writer.flush()
+    journal.close()
+    print_batch_summary(writer)
+    if resume:
+        print(f"Skipped {journal.skipped} items cloned by an earlier run")
 
-def import_task(access_token, list_id, task):
-    url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+def import_task(writer, list_id, task, journal):
+    """Queue the creation of ``task`` in ``list_id`` on the batch writer."""
     payload = {
         "title": task["title"],
         "status": task.get("status", "notStarted"),
         "dueDateTime": task.get("dueDateTime"),
         "body": {"content": task.get("body", {}).get("content", ""), "contentType": "text"}
     }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 201:
-        print(f"Imported task: {task['title']}")
+
+    def created(status, body):
+        if status == 201:
+            print(f"Imported task: {task['title']}")
+            journal.record(task_kind(list_id), task["id"], body["id"])
+        else:
+            print(f"Error importing task {task['title']}: {status}, {json.dumps(body)}")
+
+    writer.add("POST", f"/me/todo/lists/{list_id}/tasks", payload, callback=created)
+
+def print_batch_summary(*writers):
+    sent = sum(writer.requests_sent for writer in writers)
+    succeeded = sum(writer.succeeded for writer in writers)
+    failed = sum(writer.failed for writer in writers)
+    print(f"Sent {sent} batch requests for {succeeded + failed} items ({failed} failed)")
+
+def find_list(client, list_name):
+    """Return the id of the list called ``list_name``, or None."""
+    # Stop paging as soon as the list turns up.
+    for todo_list in client.iter_items("/me/todo/lists"):
+        if todo_list["displayName"] == list_name:
+            return todo_list["id"]
+    return None
+
+def iter_live_tasks(client, list_id):
+    """Yield a list's tasks with their checklist items under ``checklistItems``.
+
+    Steps come expanded with each page of tasks; if Graph refuses the
+    expansion on the first page the steps are read task by task instead.
+    """
+    tasks_url = f"/me/todo/lists/{list_id}/tasks"
+    expanded = client.iter_pages(tasks_url, params={"$expand": "checklistItems"})
+    try:
+        first = next(expanded, None)
+    except GraphError as e:
+        if e.status_code != 400:
+            raise
     else:
-        print(f"Error importing task {task['title']}: {response.status_code}, {response.text}")
+        # Past the first page tasks have been handed out; failures there
+        # are errors, not a reason to start the list over.
+        if first is not None:
+            yield from first.get("value", [])
+            for page in expanded:
+                yield from page.get("value", [])
+        return
+    for task in client.iter_items(tasks_url):
+        task["checklistItems"] = list(client.iter_items(f"{tasks_url}/{task['id']}/checklistItems"))
+        yield task
+
+def clone_live(access_token, source_list_name, new_list_name, resume=False, concurrency=DEFAULT_CONCURRENCY):
+    """Clone a list straight from Graph, steps included, without an export file.
+
+    Pages of tasks (with their steps expanded) are read in this thread and
+    handed to ``concurrency`` workers, each with its own batch writer, so
+    reading and several ``$batch`` calls overlap.  A task's steps are
+    queued as soon as the task exists.  Progress is journaled for
+    ``resume`` in ``clone-<hash>.journal.db``, one file per source and
+    target list pair.
+    """
+    client = get_client(access_token)
+    try:
+        source_list_id = find_list(client, source_list_name)
+    except GraphError as e:
+        print(f"Error fetching lists: {e}")
+        return
+    if source_list_id is None:
+        print(f"Error: Source list '{source_list_name}' not found.")
+        return
+
+    list_key = f"{source_list_id}:{new_list_name}"
+    journal = ImportJournal(f"clone-{hashlib.sha1(list_key.encode()).hexdigest()[:12]}.journal.db", resume)
+    target_list_id = journal.target("list", list_key)
+    if not target_list_id:
+        response = client.post("/me/todo/lists", json={"displayName": new_list_name})
+        if response.status_code != 201:
+            print(f"Error creating list {new_list_name}: {response.status_code}, {response.text}")
+            journal.close()
+            return
+        target_list_id = response.json()["id"]
+        journal.record("list", list_key, target_list_id)
+        print(f"Cloned list created: {new_list_name}")
+
+    writers = [BatchWriter(client) for _ in range(max(1, concurrency))]
+    # Enough tasks in hand to fill a batch for every writer.
+    tasks = queue.Queue(maxsize=len(writers) * MAX_BATCH_SIZE)
+    failed = threading.Event()
+
+    def work(writer):
+        try:
+            while (task := tasks.get()) is not None:
+                clone_task(writer, target_list_id, task, journal)
+            writer.flush()
+        except BaseException:
+            failed.set()
+            raise
+
+    def put(item):
+        """Queue ``item``; False if the queue stays full after a worker failed."""
+        while True:
+            try:
+                tasks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if failed.is_set():
+                    return False
+
+    with ThreadPoolExecutor(max_workers=len(writers)) as pool:
+        workers = [pool.submit(work, writer) for writer in writers]
+        try:
+            for task in iter_live_tasks(client, source_list_id):
+                if failed.is_set() or not put(task):
+                    break
+        except GraphError as e:
+            print(f"Error fetching tasks for list {source_list_name}: {e}")
+        finally:
+            for _ in writers:
+                # A failed worker takes nothing more; drop what it left so
+                # every stop marker fits.
+                while not put(None):
+                    drain(tasks)
+    for worker in workers:
+        worker.result()
+    journal.close()
+    print_batch_summary(*writers)
+    if resume:
+        print(f"Skipped {journal.skipped} items cloned by an earlier run")
+
+def drain(q):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+def clone_task(writer, list_id, task, journal):
+    """Queue a full copy of ``task`` in ``list_id``, then its checklist items."""
+    target_id = journal.target(task_kind(list_id), task["id"])
+    if target_id:
+        queue_steps(writer, list_id, target_id, task, journal)
+        return
+    payload = {field: task[field] for field in TASK_FIELDS if task.get(field) is not None}
+
+    def created(status, body):
+        if status == 201:
+            print(f"Imported task: {task['title']}")
+            journal.record(task_kind(list_id), task["id"], body["id"])
+            queue_steps(writer, list_id, body["id"], task, journal)
+        else:
+            print(f"Error importing task {task['title']}: {status}, {json.dumps(body)}")
+
+    writer.add("POST", f"/me/todo/lists/{list_id}/tasks", payload, callback=created)
+
+def queue_steps(writer, list_id, task_id, task, journal):
+    for step in task.get("checklistItems", []):
+        if journal.target(step_kind(task_id), step["id"]):
+            continue
+        payload = {field: step[field] for field in STEP_FIELDS if field in step}
+
+        def created(status, body, step=step):
+            if status == 201:
+                journal.record(step_kind(task_id), step["id"], body["id"])
+            else:
+                print(f"Error importing step {step.get('displayName')}: {status}, {json.dumps(body)}")
+
+        writer.add("POST", f"/me/todo/lists/{list_id}/tasks/{task_id}/checklistItems", payload, callback=created)
 
 def main():
     parser = argparse.ArgumentParser(description="Clone a Microsoft To-Do list and push it to Microsoft To-Do.")
-    parser.add_argument("filename", help="Filename containing exported To-Do lists")
+    parser.add_argument("filename", nargs="?", help="Filename containing exported To-Do lists (not with --from-live)")
     parser.add_argument("source_list_name", help="The name of the list to clone")
     parser.add_argument("new_list_name", help="The name for the new cloned list")
+    parser.add_argument("--from-live", action="store_true",
+                        help="Read the source list from Microsoft To-Do, steps included, instead of an export")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"With --from-live, number of batch requests in flight (default {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip tasks an earlier, interrupted clone already created")
     args = parser.parse_args()
+    if args.from_live == bool(args.filename):
+        parser.error("give either an export filename or --from-live")
     
     token = get_access_token()
-    clone_todo_list(token, args.filename, args.source_list_name, args.new_list_name)
+    if args.from_live:
+        with metrics.time("phase", "clone_live"):
+            clone_live(token, args.source_list_name, args.new_list_name, args.resume, args.concurrency)
+    else:
+        with metrics.time("phase", "clone"):
+            clone_todo_list(token, args.filename, args.source_list_name, args.new_list_name, args.resume)
 
 if __name__ == "__main__":
     main()
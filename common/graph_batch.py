@@ -0,0 +1,128 @@
+"""Pack Graph write calls into JSON ``$batch`` requests.
+
+Creating a list, its tasks and their steps one POST at a time costs a round
+trip per item.  ``BatchWriter`` queues those calls and sends them to
+``/$batch`` up to 20 at a time, then hands each sub-response back to the
+callback registered for that call.
+
+Graph cannot feed the id created by one sub-request into the URL of another,
+so a task cannot be queued until its list exists.  Callbacks cover that: the
+callback for a new list queues the list's tasks, the callback for a new task
+queues its steps, and ``flush`` keeps sending until nothing is left.
+
+Sub-requests Graph throttles (429/503) are put back at the front of the queue
+and resent after their ``Retry-After`` delay.
+"""
+import itertools
+import json
+
+from graph_client import MAX_RETRIES, limiter
+from graph_metrics import metrics
+from graph_throttle import THROTTLE_STATUSES, retry_after
+
+MAX_BATCH_SIZE = 20
+
+
+class BatchWriter:
+    """Queue Graph calls and send them as ``$batch`` requests."""
+
+    def __init__(self, client, batch_size=MAX_BATCH_SIZE):
+        self.client = client
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.pending = []
+        self.succeeded = 0
+        self.failed = 0
+        self.requests_sent = 0
+        self._ids = itertools.count(1)
+        self._sending = False
+
+    def add(self, method, path, body=None, callback=None):
+        """Queue a call.
+
+        ``callback(status, body)`` runs once the call's sub-response is back
+        and may queue follow-up calls.
+        """
+        self.pending.append({
+            "id": str(next(self._ids)),
+            "method": method,
+            "url": "/" + path.lstrip("/"),
+            "body": body,
+            "callback": callback,
+            "attempts": 0,
+        })
+        # Send full batches as they fill up, but never from inside a
+        # callback: the batch that triggered it is still being unpacked.
+        if not self._sending and len(self.pending) >= self.batch_size:
+            self._send(self._take_batch())
+
+    def flush(self):
+        """Send everything queued, including calls queued by callbacks."""
+        while self.pending:
+            self._send(self._take_batch())
+
+    def _take_batch(self):
+        batch = self.pending[:self.batch_size]
+        self.pending = self.pending[self.batch_size:]
+        return batch
+
+    def _send(self, batch):
+        if not batch:
+            return
+        self._sending = True
+        try:
+            self._send_batch(batch)
+        finally:
+            self._sending = False
+
+    def _send_batch(self, batch):
+        sub_requests = []
+        for call in batch:
+            request = {"id": call["id"], "method": call["method"], "url": call["url"]}
+            if call["body"] is not None:
+                request["headers"] = {"Content-Type": "application/json"}
+                request["body"] = call["body"]
+            sub_requests.append(request)
+
+        response = self.client.post("/$batch", json={"requests": sub_requests}, cost=len(sub_requests))
+        self.requests_sent += 1
+        if response.status_code == 200:
+            responses = {r["id"]: r for r in response.json().get("responses", [])}
+        else:
+            error = _decode(response.text)
+            responses = {call["id"]: {"status": response.status_code, "body": error} for call in batch}
+
+        retry, delay = [], 0.0
+        # Report in the order the calls were queued, not the order Graph
+        # happened to finish them.
+        for call in batch:
+            sub = responses.get(call["id"], {"status": 500, "body": {"error": "missing response"}})
+            status = sub.get("status", 500)
+            metrics.record_subrequest(call["method"], call["url"], status)
+            if status in THROTTLE_STATUSES and call["attempts"] < MAX_RETRIES:
+                call["attempts"] += 1
+                retry.append(call)
+                delay = max(delay, retry_after(sub.get("headers"), call["attempts"]))
+                continue
+            self._finish(call, status, sub.get("body"))
+        if retry:
+            limiter.backoff(delay)
+            self.pending = retry + self.pending
+
+    def _finish(self, call, status, body):
+        if _ok(status):
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        if call["callback"]:
+            call["callback"](status, body)
+
+
+def _ok(status):
+    return 200 <= status < 300
+
+
+def _decode(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
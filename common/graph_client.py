@@ -0,0 +1,161 @@
+"""Shared Microsoft Graph client used by the To Do and OneDrive scripts.
+
+Each script used to call the bare ``requests.get``/``requests.post`` helpers,
+which open a fresh TCP+TLS connection to graph.microsoft.com per call.  The
+client here keeps one pooled keep-alive ``Session`` per token with the auth
+headers already attached, so every call after the first reuses a connection.
+
+Scripts live in their own folders, so they put this folder on ``sys.path``
+before importing it:
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+    from graph_client import get_client
+"""
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from graph_metrics import metrics
+from graph_throttle import THROTTLE_STATUSES, AdaptiveLimiter, retry_after
+
+GRAPH_ROOT = os.environ.get("GRAPH_ROOT", "https://graph.microsoft.com/v1.0")
+DEFAULT_POOL_SIZE = int(os.environ.get("GRAPH_POOL_SIZE", "10"))
+DEFAULT_PAGE_SIZE = int(os.environ.get("GRAPH_PAGE_SIZE", "100"))
+MAX_RETRIES = int(os.environ.get("GRAPH_MAX_RETRIES", "6"))
+
+# One limiter for the whole process: Graph throttles per user and app, not
+# per connection.
+limiter = AdaptiveLimiter(
+    rate=float(os.environ.get("GRAPH_RATE", "20")),
+    max_concurrency=int(os.environ.get("GRAPH_MAX_CONCURRENCY", "16")),
+)
+
+
+class GraphError(Exception):
+    """A Graph call returned an unexpected status code."""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        super().__init__(f"{response.status_code}, {response.text}")
+
+
+class GraphClient:
+    """A pooled keep-alive session bound to one access token."""
+
+    def __init__(self, token, pool_size=DEFAULT_POOL_SIZE, root=GRAPH_ROOT):
+        self.root = root.rstrip("/")
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        """Return an absolute URL; paths are relative to the Graph root."""
+        if path.startswith(("https://", "http://")):
+            return path
+        return f"{self.root}/{path.lstrip('/')}"
+
+    def request(self, method, path, cost=1, **kwargs):
+        """Send one call through the shared limiter.
+
+        429 and 503 responses are retried after their ``Retry-After`` delay
+        up to ``GRAPH_MAX_RETRIES`` times; the last response is returned
+        either way.  ``cost`` is how many rate tokens the call uses (a
+        ``$batch`` counts each of its sub-requests).  Every attempt is
+        recorded in ``graph_metrics.metrics``.
+        """
+        url = self.url(path)
+        attempt = 0
+        while True:
+            limiter.acquire(cost)
+            response = None
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            finally:
+                limiter.release(response is not None and response.status_code in THROTTLE_STATUSES)
+            metrics.record_request(method, url, response, time.monotonic() - start, attempt,
+                                   kwargs.get("stream", False))
+            if response.status_code not in THROTTLE_STATUSES:
+                return response
+            metrics.record_throttle(method, url)
+            if attempt >= MAX_RETRIES:
+                return response
+            response.close()
+            limiter.backoff(retry_after(response.headers, attempt))
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def iter_pages(self, path, page_size=None, params=None, on_response=None):
+        """Yield each page of a collection, following ``@odata.nextLink``.
+
+        Pages are yielded as they arrive, so callers can start on the first
+        page before the last one is fetched.  ``page_size`` is sent as
+        ``$top`` (``GRAPH_PAGE_SIZE`` if not given, 0 to leave it out).
+        ``on_response(response)`` is called for every page fetched, e.g. to
+        log it.  Raises ``GraphError`` on any non-200 response.
+        """
+        params = dict(params or {})
+        page_size = DEFAULT_PAGE_SIZE if page_size is None else page_size
+        if page_size:
+            params["$top"] = page_size
+        url = self.url(path)
+        while url:
+            response = self.get(url, params=params)
+            if on_response:
+                on_response(response)
+            if response.status_code != 200:
+                raise GraphError(response)
+            page = response.json()
+            # Read the link before handing the page out; callers may trim it.
+            url = page.get("@odata.nextLink")
+            # The next link already carries the original query string.
+            params = None
+            yield page
+
+    def iter_items(self, path, page_size=None, params=None, on_response=None):
+        """Yield the items of a collection one by one across all pages."""
+        for page in self.iter_pages(path, page_size, params, on_response):
+            yield from page.get("value", [])
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token, pool_size=None):
+    """Return the shared client for ``token``, creating it on first use.
+
+    ``pool_size`` only applies when the client is created; it defaults to
+    ``GRAPH_POOL_SIZE`` from the environment (10 if unset).
+    """
+    with _clients_lock:
+        client = _clients.get(token)
+        if client is None:
+            client = GraphClient(token, pool_size or DEFAULT_POOL_SIZE)
+            _clients[token] = client
+        return client
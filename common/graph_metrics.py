@@ -0,0 +1,245 @@
+"""Run metrics for the Graph scripts.
+
+Every call made through ``GraphClient.request`` is counted here per
+endpoint template (ids replaced by ``{id}``, so ``/me/todo/lists/{id}/tasks``
+collects every list's task pages), with a latency histogram, bytes
+received, retries and throttled responses.  Scripts add the time spent in
+each phase and in database writes with ``metrics.time(...)``.
+
+Set ``GRAPH_METRICS`` to a file name to get a report when the script exits:
+a Prometheus textfile if the name ends in ``.prom``, a JSON run report
+otherwise.
+"""
+import atexit
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+METRICS_FILE = os.environ.get("GRAPH_METRICS")
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# Path segments that are followed by an item id.
+_ID_PARENTS = {"lists", "tasks", "checklistItems", "items", "linkedResources", "attachments"}
+_VERSION = re.compile(r"^/(v1\.0|beta)(?=/)")
+
+
+def endpoint_template(url):
+    """``/me/todo/lists/AAMk.../tasks?$top=100`` -> ``/me/todo/lists/{id}/tasks``."""
+    path = _VERSION.sub("", urlparse(url).path)
+    segments = path.strip("/").split("/")
+    for i in range(1, len(segments)):
+        if segments[i - 1] in _ID_PARENTS:
+            segments[i] = "{id}"
+    return "/" + "/".join(segments)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            yield bound, total
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile."""
+        target = q * self.count
+        for bound, total in self.cumulative():
+            if total >= target:
+                return bound
+        return None
+
+
+class EndpointStats:
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram()
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+
+
+class Metrics:
+    """Thread-safe counters for one run of a script."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.subrequests = {}
+        self.timings = {}
+
+    def _endpoint(self, method, url):
+        key = (method, endpoint_template(url))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = EndpointStats()
+        return stats
+
+    def record_request(self, method, url, response, seconds, attempt=0, stream=False):
+        """Count one HTTP exchange; ``attempt`` > 0 marks a retry.
+
+        The body of a ``stream`` response is left to the caller, so without
+        a Content-Length its bytes are not counted.
+        """
+        length = response.headers.get("Content-Length")
+        if length is None and not stream:
+            length = len(response.content or b"")
+        with self.lock:
+            stats = self._endpoint(method, url)
+            status = str(response.status_code)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency.observe(seconds)
+            stats.bytes += int(length or 0)
+            if attempt:
+                stats.retries += 1
+
+    def record_throttle(self, method, url):
+        with self.lock:
+            self._endpoint(method, url).throttled += 1
+
+    def record_subrequest(self, method, url, status):
+        """Count one sub-request of a ``$batch`` by its own endpoint."""
+        key = (method, endpoint_template(url), str(status))
+        with self.lock:
+            self.subrequests[key] = self.subrequests.get(key, 0) + 1
+
+    @contextlib.contextmanager
+    def time(self, category, name):
+        """Add the time spent in the block to ``category``/``name`` (e.g. phase/export, db/populate)."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                entry = self.timings.setdefault((category, name), [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def report(self):
+        """The run as a JSON-serializable dict."""
+        with self.lock:
+            endpoints = []
+            for (method, endpoint), stats in sorted(self.endpoints.items()):
+                endpoints.append({
+                    "method": method,
+                    "endpoint": endpoint,
+                    "requests": sum(stats.statuses.values()),
+                    "statuses": dict(stats.statuses),
+                    "bytes": stats.bytes,
+                    "retries": stats.retries,
+                    "throttled": stats.throttled,
+                    "latency_seconds": {
+                        "sum": round(stats.latency.sum, 6),
+                        "p50_le": stats.latency.quantile(0.5),
+                        "p95_le": stats.latency.quantile(0.95),
+                        "buckets": {_le(bound): n for bound, n in stats.latency.cumulative()},
+                    },
+                })
+            subrequests = [{"method": m, "endpoint": e, "status": s, "count": n}
+                           for (m, e, s), n in sorted(self.subrequests.items())]
+            timings = {}
+            for (category, name), (count, seconds) in sorted(self.timings.items()):
+                timings.setdefault(category, {})[name] = {"count": count, "seconds": round(seconds, 6)}
+        return {
+            "script": os.path.basename(sys.argv[0]),
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "duration_seconds": round(time.time() - self.started, 6),
+            "endpoints": endpoints,
+            "batch_subrequests": subrequests,
+            "timings": timings,
+        }
+
+    def prometheus(self):
+        """The run in the Prometheus text exposition format."""
+        report = self.report()
+        script = report["script"]
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def sample(name, labels, value):
+            labels = dict(script=script, **labels)
+            text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+            lines.append(f"{name}{{{text}}} {value}")
+
+        metric("graph_requests_total", "counter", "Graph calls by endpoint template and status.")
+        for e in report["endpoints"]:
+            for status, n in sorted(e["statuses"].items()):
+                sample("graph_requests_total", {"method": e["method"], "endpoint": e["endpoint"], "status": status}, n)
+        metric("graph_request_duration_seconds", "histogram", "Graph call latency by endpoint template.")
+        for e in report["endpoints"]:
+            labels = {"method": e["method"], "endpoint": e["endpoint"]}
+            for le, n in e["latency_seconds"]["buckets"].items():
+                sample("graph_request_duration_seconds_bucket", dict(labels, le=le), n)
+            sample("graph_request_duration_seconds_sum", labels, e["latency_seconds"]["sum"])
+            sample("graph_request_duration_seconds_count", labels, e["requests"])
+        for name, field, help_text in (
+                ("graph_response_bytes_total", "bytes", "Response bytes received."),
+                ("graph_retries_total", "retries", "Calls that were retries of a throttled call."),
+                ("graph_throttled_total", "throttled", "Responses throttled with 429 or 503.")):
+            metric(name, "counter", help_text)
+            for e in report["endpoints"]:
+                sample(name, {"method": e["method"], "endpoint": e["endpoint"]}, e[field])
+        metric("graph_batch_subrequests_total", "counter", "$batch sub-requests by endpoint template and status.")
+        for s in report["batch_subrequests"]:
+            sample("graph_batch_subrequests_total",
+                   {"method": s["method"], "endpoint": s["endpoint"], "status": s["status"]}, s["count"])
+        metric("graph_time_seconds", "gauge", "Time spent per phase or database operation.")
+        for category, names in report["timings"].items():
+            for name, t in names.items():
+                sample("graph_time_seconds", {"category": category, "name": name}, t["seconds"])
+        metric("graph_run_seconds", "gauge", "Duration of the run.")
+        sample("graph_run_seconds", {}, report["duration_seconds"])
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """Write the report; ``.prom`` files get the Prometheus format."""
+        if filename.endswith(".prom"):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.report(), indent=2) + "\n"
+        # The textfile collector may read at any moment: replace, never rewrite.
+        tmp = f"{filename}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, filename)
+
+
+def _le(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# One collector per process, shared like graph_client.limiter.
+metrics = Metrics()
+
+if METRICS_FILE:
+    atexit.register(metrics.write, METRICS_FILE)
@@ -0,0 +1,141 @@
+"""Pacing and back-off for Graph calls.
+
+Graph throttles per user and per app, so every call made by a script goes
+through one ``AdaptiveLimiter``:
+
+* a token bucket caps the steady request rate (``GRAPH_RATE`` per second),
+* an AIMD window caps how many calls are in flight: it halves when Graph
+  answers 429/503 and grows by one after a full window of clean responses,
+* ``backoff`` holds every caller until a ``Retry-After`` deadline has passed.
+"""
+import collections
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+THROTTLE_STATUSES = (429, 503)
+MAX_BACKOFF = 60.0
+
+
+class TokenBucket:
+    """Hand out ``rate`` tokens per second with bursts of up to ``burst``."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        # A cost above the bucket size would never fit; let it through once
+        # the bucket is full instead.
+        cost = min(cost, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Token bucket plus an AIMD concurrency window shared by all callers."""
+
+    def __init__(self, rate, max_concurrency, min_concurrency=1):
+        self.bucket = TokenBucket(rate)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = self.max_concurrency
+        self.active = 0
+        self.clean_streak = 0
+        self.resume_at = 0.0
+        self.throttled = 0
+        self.cond = threading.Condition()
+        self.completed = collections.deque()
+
+    def acquire(self, cost=1):
+        with self.cond:
+            while True:
+                delay = self.resume_at - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                elif self.active >= self.limit:
+                    self.cond.wait()
+                else:
+                    break
+            self.active += 1
+        self.bucket.acquire(cost)
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.active -= 1
+            now = time.monotonic()
+            self.completed.append(now)
+            while self.completed and self.completed[0] < now - 5:
+                self.completed.popleft()
+            # A throttled call shrinks the window through backoff(), which
+            # also knows how long to hold off.
+            if throttled:
+                self.clean_streak = 0
+            else:
+                self.clean_streak += 1
+                if self.clean_streak >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.clean_streak = 0
+            self.cond.notify_all()
+
+    def backoff(self, delay):
+        """Shrink the window and hold every caller for ``delay`` seconds."""
+        with self.cond:
+            now = time.monotonic()
+            self.throttled += 1
+            # Calls that were already in flight when the first 429 came back
+            # report it too; shrink once per back-off, not once per call.
+            if now >= self.resume_at:
+                self._decrease()
+            self.resume_at = max(self.resume_at, now + delay)
+            self.cond.notify_all()
+
+    def _decrease(self):
+        self.clean_streak = 0
+        self.limit = max(self.min_concurrency, self.limit // 2)
+
+    def rate(self):
+        """Calls completed per second over the last five seconds."""
+        with self.cond:
+            now = time.monotonic()
+            recent = [t for t in self.completed if t >= now - 5]
+        if len(recent) < 2:
+            return float(len(recent))
+        return len(recent) / max(now - recent[0], 1.0)
+
+    def describe(self):
+        return f"{self.rate():.1f} req/s, {self.active}/{self.limit} in flight"
+
+
+def retry_after(headers, attempt):
+    """Seconds to wait before retrying a throttled call.
+
+    Uses the ``Retry-After`` header (seconds or an HTTP date) when present,
+    otherwise exponential back-off with jitter.
+    """
+    value = None
+    for key, header in (headers or {}).items():
+        if key.lower() == "retry-after":
+            value = header
+            break
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return min(MAX_BACKOFF, 2 ** attempt) * (0.5 + random.random() / 2)
@@ -0,0 +1,62 @@
+"""Progress journal for imports and clones.
+
+Every list and task created during an import is recorded as
+``(kind, source id) -> target id`` in a small SQLite file as soon as Graph
+confirms it. A run started with ``--resume`` looks items up here and skips
+the ones that already exist, so an import that died halfway (expired token,
+dropped network, throttling) carries on where it stopped instead of creating
+duplicates.
+
+Kinds are ``"list"`` for lists, ``"task:<target list id>"`` for tasks and
+``"step:<target task id>"`` for checklist items, so the same source task can
+be cloned into several lists.  One journal can be shared by several threads.
+"""
+import os
+import sqlite3
+import threading
+
+
+class ImportJournal:
+    def __init__(self, path, resume=False):
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS created (
+                                kind TEXT,
+                                source_id TEXT,
+                                target_id TEXT,
+                                PRIMARY KEY (kind, source_id)
+                            )''')
+        self.conn.commit()
+        self.skipped = 0
+
+    def target(self, kind, source_id):
+        """Return the id created for ``source_id`` on an earlier run, if any."""
+        with self.lock:
+            row = self.conn.execute("SELECT target_id FROM created WHERE kind = ? AND source_id = ?",
+                                    (kind, source_id)).fetchone()
+            if row:
+                self.skipped += 1
+                return row[0]
+        return None
+
+    def record(self, kind, source_id, target_id):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO created (kind, source_id, target_id) VALUES (?, ?, ?)",
+                              (kind, source_id, target_id))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def task_kind(target_list_id):
+    return f"task:{target_list_id}"
+
+
+def step_kind(target_task_id):
+    return f"step:{target_task_id}"
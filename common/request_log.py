@@ -0,0 +1,154 @@
+"""Request logs that stay out of the way of the work being logged.
+
+The scripts used to open their log file for every line, and the To Do diff
+wrote every response body in full, so the log grew as large as the data.
+``get_logger`` returns a ``logging.Logger`` whose records are handed to a
+background thread through a queue; that thread writes them with a buffered
+file that is flushed whenever the queue runs dry and rotated by size.
+
+Settings come from the environment:
+
+* ``GRAPH_LOG_LEVEL``: ``DEBUG`` also logs successful response bodies,
+  ``INFO`` (default) one line per request with bodies only for errors,
+  ``WARNING`` only failures;
+* ``GRAPH_LOG_BODY_LIMIT``: characters of a body to keep (default 512);
+* ``GRAPH_LOG_MAX_BYTES``/``GRAPH_LOG_BACKUPS``: rotate at this size
+  (default 10 MB, 0 to never rotate) and keep this many old files
+  (default 3).
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+LOG_LEVEL = os.environ.get("GRAPH_LOG_LEVEL", "INFO").upper()
+LOG_BODY_LIMIT = int(os.environ.get("GRAPH_LOG_BODY_LIMIT", "512"))
+LOG_MAX_BYTES = int(os.environ.get("GRAPH_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("GRAPH_LOG_BACKUPS", "3"))
+BUFFER_SIZE = 64 * 1024
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+class RotatingWriter(logging.Handler):
+    """Buffered log file rotated by size, written only by the listener thread.
+
+    ``RotatingFileHandler`` flushes and asks the file for its position on
+    every record; this keeps a running byte count instead and leaves
+    flushing to the listener.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.stream = None
+        self.size = 0
+
+    def _open(self):
+        self.stream = open(self.filename, "a", encoding="utf-8", buffering=BUFFER_SIZE)
+        self.size = os.path.getsize(self.filename)
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+            if self.stream is None:
+                self._open()
+            if self.max_bytes and self.size and self.size + len(line) > self.max_bytes:
+                self.rotate()
+            self.stream.write(line)
+            self.size += len(line)
+        except Exception:
+            self.handleError(record)
+
+    def rotate(self):
+        self.stream.close()
+        self.stream = None
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.filename}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.filename}.{i + 1}")
+        if self.backups:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+        self._open()
+
+    def flush(self):
+        if self.stream:
+            self.stream.flush()
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        super().close()
+
+
+class FlushingListener(logging.handlers.QueueListener):
+    """Queue listener that flushes its handlers whenever it has caught up."""
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get(block=False)
+        except queue.Empty:
+            if not block:
+                raise
+        for handler in self.handlers:
+            handler.flush()
+        return self.queue.get(block=True)
+
+
+def get_logger(filename):
+    """Return the background-written logger for ``filename``, creating it on first use."""
+    with _loggers_lock:
+        logger = _loggers.get(filename)
+        if logger is not None:
+            return logger
+        writer = RotatingWriter(filename)
+        writer.setFormatter(logging.Formatter("[%(asctime)s] %(message)s"))
+        records = queue.SimpleQueue()
+        listener = FlushingListener(records, writer)
+        listener.start()
+        # Stop drains the queue, then closing the writer flushes it.
+        atexit.register(writer.close)
+        atexit.register(listener.stop)
+
+        logger = logging.getLogger(f"graph.requests.{filename}")
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        _loggers[filename] = logger
+        return logger
+
+
+def cap(text, limit=LOG_BODY_LIMIT):
+    """``text`` cut to ``limit`` characters, noting how much was left out."""
+    if text is None or len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more chars]"
+
+
+def log_response(logger, response, stream=False):
+    """Log one line for a Graph response.
+
+    The body is only read for failures, or for every response at DEBUG, and
+    is capped at ``GRAPH_LOG_BODY_LIMIT`` characters.  The body of a
+    ``stream`` response (a download) is never read.
+    """
+    request = response.request
+    line = (f"{request.method} {response.url} | Status: {response.status_code} | "
+            f"{response.elapsed.total_seconds() * 1000:.0f} ms")
+    length = response.headers.get("Content-Length")
+    if length is not None:
+        line += f" | {length} bytes"
+    if not response.ok:
+        logger.warning("%s | Response: %s", line, "(streamed)" if stream else cap(response.text))
+    elif logger.isEnabledFor(logging.DEBUG) and not stream:
+        logger.debug("%s | Response: %s", line, cap(response.text))
+    else:
+        logger.info(line)
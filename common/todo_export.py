@@ -0,0 +1,181 @@
+"""Read and write To Do exports.
+
+Two formats are supported:
+
+* the original ``.json`` export: one ``{"@odata.context", "value": [...]}``
+  document with each list's tasks under ``"tasks"``;
+* line-delimited JSON (``.ndjson``/``.jsonl``): one record per line, written
+  as pages arrive and read back one line at a time, so memory stays flat
+  however large the account is::
+
+      {"type": "header", "data": {"@odata.context": ...}}
+      {"type": "list", "data": {...list without tasks...}}
+      {"type": "task", "list_id": "...", "data": {...task...}}
+
+  A list's task records follow its list record.
+
+``iter_records`` yields the same records for both formats, so importers only
+deal with one shape.
+
+A line-delimited export can have a sidecar index, ``<filename>.index.json``,
+giving the byte offset and record count of each list's block.  The exporter
+writes it; for older exports it is built by the first scan that needs it.
+With ``lists``, ``iter_records`` seeks straight to the blocks of those lists
+instead of reading the whole file.  The index stores the export's size and
+modification time and is ignored once they no longer match.
+"""
+import json
+import os
+
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+
+def is_ndjson_name(filename):
+    return filename.lower().endswith(NDJSON_EXTENSIONS)
+
+
+def is_ndjson_file(filename):
+    """True if ``filename`` holds line-delimited records, whatever its name."""
+    with open(filename, "r", encoding="utf-8") as f:
+        first = f.readline()
+    try:
+        record = json.loads(first)
+    except ValueError:
+        # An indented .json export starts with a lone "{".
+        return False
+    return isinstance(record, dict) and "type" in record
+
+
+def write_record(f, record_type, data, list_id=None):
+    record = {"type": record_type}
+    if list_id is not None:
+        record["list_id"] = list_id
+    record["data"] = data
+    f.write(json.dumps(record))
+    f.write("\n")
+
+
+def index_filename(filename):
+    return f"{filename}.index.json"
+
+
+def write_index(filename, lists):
+    """Write the sidecar index for ``filename``.
+
+    ``lists`` holds one ``{"id", "displayName", "offset", "tasks"}`` entry per
+    list, in file order: the list record starts at byte ``offset`` and is
+    followed by ``tasks`` task records.
+    """
+    stat = os.stat(filename)
+    index = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "lists": lists}
+    tmp = f"{index_filename(filename)}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_filename(filename))
+
+
+def load_index(filename):
+    """The index entries for ``filename``, or None if there is no current index."""
+    try:
+        with open(index_filename(filename), "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(filename)
+    if index.get("size") != stat.st_size or index.get("mtime_ns") != stat.st_mtime_ns:
+        return None
+    return index["lists"]
+
+
+def build_index(filename):
+    """Scan a line-delimited export once and write its index.
+
+    Only list records are parsed.  Returns the entries, or None if the file
+    was not written by ``write_record`` or some list's tasks are not all in
+    one block, in which case the export cannot be indexed.
+    """
+    lists = []
+    current = None
+    with open(filename, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.startswith(b'{"type": "task"'):
+                # write_record puts list_id right after the type.
+                if current is None or not line.startswith(current["prefix"]):
+                    return None
+                current["tasks"] += 1
+            elif line.startswith(b'{"type": "list"'):
+                todo_list = json.loads(line)["data"]
+                prefix = f'{{"type": "task", "list_id": {json.dumps(todo_list["id"])},'.encode()
+                current = {"id": todo_list["id"], "displayName": todo_list.get("displayName"),
+                           "offset": offset, "tasks": 0, "prefix": prefix}
+                lists.append(current)
+            elif not line.startswith(b'{"type": "header"'):
+                # Blank or foreign lines would throw the record counts off.
+                return None
+            offset += len(line)
+    for entry in lists:
+        del entry["prefix"]
+    write_index(filename, lists)
+    return lists
+
+
+def iter_records(filename, lists=None):
+    """Yield the records of an export, in either format.
+
+    ``lists`` limits the output to the header and the lists whose name or
+    id is in it, with their tasks.  Indexed line-delimited exports then only
+    read those lists' blocks.
+    """
+    if lists is not None:
+        lists = set(lists)
+    if is_ndjson_file(filename):
+        index = None
+        if lists is not None:
+            index = load_index(filename) or build_index(filename)
+        if index is not None:
+            yield from _iter_indexed(filename, index, lists)
+            return
+        with open(filename, "r", encoding="utf-8") as f:
+            yield from _select((json.loads(line) for line in f if line.strip()), lists)
+        return
+
+    # The original format has to be parsed in one go.
+    with open(filename, "r", encoding="utf-8") as f:
+        todo_data = json.load(f)
+    if lists is not None:
+        todo_data["value"] = [todo_list for todo_list in todo_data.get("value", [])
+                              if todo_list["id"] in lists or todo_list.get("displayName") in lists]
+    header = {key: value for key, value in todo_data.items() if key != "value"}
+    yield {"type": "header", "data": header}
+    for todo_list in todo_data.get("value", []):
+        tasks = todo_list.get("tasks", [])
+        yield {"type": "list", "data": {key: value for key, value in todo_list.items() if key != "tasks"}}
+        for task in tasks:
+            yield {"type": "task", "list_id": todo_list["id"], "data": task}
+
+
+def _select(records, lists=None):
+    """Filter ``records`` down to the header and the lists named in ``lists``."""
+    wanted = set()
+    for record in records:
+        if lists is None or record["type"] == "header":
+            yield record
+        elif record["type"] == "list":
+            todo_list = record["data"]
+            if todo_list["id"] in lists or todo_list.get("displayName") in lists:
+                wanted.add(todo_list["id"])
+                yield record
+        elif record.get("list_id") in wanted:
+            yield record
+
+
+def _iter_indexed(filename, index, lists):
+    with open(filename, "rb") as f:
+        yield json.loads(f.readline())
+        for entry in index:
+            if entry["id"] not in lists and entry["displayName"] not in lists:
+                continue
+            f.seek(entry["offset"])
+            for _ in range(1 + entry["tasks"]):
+                yield json.loads(f.readline())
@@ -1,15 +1,19 @@
-import requests
 import openpyxl
 import os
 import argparse
 import logging
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from graph_batch import BatchWriter
+from graph_client import get_client
+from graph_metrics import metrics
+
 # Setup logging
 logging.basicConfig(filename='logfile.log', level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-GRAPH_ROOT = 'https://graph.microsoft.com/v1.0/me/todo/lists'
+GRAPH_ROOT = '/me/todo/lists'
 
 # Read token from file
 def read_token(token_file='token'):
@@ -23,26 +27,24 @@ def read_token(token_file='token'):
         sys.exit(1)
 
 # Get existing To Do lists
-def get_todo_lists(headers):
+def get_todo_lists(client):
     url = GRAPH_ROOT
     try:
         logging.debug(f"GET {url}")
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        lists = response.json().get('value', [])
-        logging.debug(f"Fetched {len(lists)} existing lists from {url}. Status: {response.status_code}")
+        lists = list(client.iter_items(url))
+        logging.debug(f"Fetched {len(lists)} existing lists from {url}.")
         return lists
     except Exception as e:
         logging.error(f"Failed to fetch To Do lists from {url}: {e}")
         return []
 
 # Create a new list
-def create_list(list_name, headers):
+def create_list(list_name, client):
     url = GRAPH_ROOT
     try:
         payload = {"displayName": list_name}
         logging.debug(f"POST {url} with payload {payload}")
-        response = requests.post(url, headers=headers, json=payload)
+        response = client.post(url, json=payload)
         response.raise_for_status()
         logging.debug(f"Created list '{list_name}' at {url}. Status: {response.status_code}")
         return response.json()
@@ -51,114 +53,144 @@ def create_list(list_name, headers):
         return None
 
 # Get tasks for a given list
-def get_tasks(list_id, headers):
+def get_tasks(list_id, client):
     url = f"{GRAPH_ROOT}/{list_id}/tasks"
     try:
         logging.debug(f"GET {url}")
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        tasks = response.json().get('value', [])
-        logging.debug(f"Fetched {len(tasks)} tasks for list ID {list_id} from {url}. Status: {response.status_code}")
+        tasks = list(client.iter_items(url))
+        logging.debug(f"Fetched {len(tasks)} tasks for list ID {list_id} from {url}.")
         return tasks
     except Exception as e:
         logging.error(f"Failed to fetch tasks for list {list_id} from {url}: {e}")
         return []
 
-# Create a new task
-def create_task(list_id, task_name, headers):
+# Queue a new task; on_created gets the task object once its batch returns
+def create_task(list_id, task_name, writer, on_created=None):
     url = f"{GRAPH_ROOT}/{list_id}/tasks"
-    try:
-        payload = {"title": task_name}
-        logging.debug(f"POST {url} with payload {payload}")
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        logging.debug(f"Created task '{task_name}' at {url}. Status: {response.status_code}")
-        return response.json()
-    except Exception as e:
-        logging.error(f"Failed to create task '{task_name}' at {url}: {e}")
-        return None
+    payload = {"title": task_name}
+    logging.debug(f"Queue POST {url} with payload {payload}")
+
+    def done(status, body):
+        if status == 201:
+            logging.debug(f"Created task '{task_name}' at {url}. Status: {status}")
+            if on_created:
+                on_created(body)
+        else:
+            logging.error(f"Failed to create task '{task_name}' at {url}: {status} {body}")
+
+    writer.add("POST", url, payload, callback=done)
 
 # Get steps for a given task
-def get_steps(list_id, task_id, headers):
+def get_steps(list_id, task_id, client):
     url = f"{GRAPH_ROOT}/{list_id}/tasks/{task_id}/checklistItems"
     try:
         logging.debug(f"GET {url}")
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        steps = response.json().get('value', [])
-        logging.debug(f"Fetched {len(steps)} steps for task ID {task_id} from {url}. Status: {response.status_code}")
+        steps = list(client.iter_items(url))
+        logging.debug(f"Fetched {len(steps)} steps for task ID {task_id} from {url}.")
         return steps
     except Exception as e:
         logging.error(f"Failed to fetch steps for task {task_id} from {url}: {e}")
         return []
 
-# Create a new step
-def create_step(list_id, task_id, step_name, headers):
+# Queue a new step; on_created gets the step object once its batch returns
+def create_step(list_id, task_id, step_name, writer, on_created=None):
     url = f"{GRAPH_ROOT}/{list_id}/tasks/{task_id}/checklistItems"
+    payload = {"displayName": step_name}
+    logging.debug(f"Queue POST {url} with payload {payload}")
+
+    def done(status, body):
+        if status == 201:
+            logging.debug(f"Created step '{step_name}' at {url}. Status: {status}")
+            if on_created:
+                on_created(body)
+        else:
+            logging.error(f"Failed to create step '{step_name}' at {url}: {status} {body}")
+
+    writer.add("POST", url, payload, callback=done)
+
+# Read the sheet as {task: [steps]} in sheet order, streaming the rows
+def read_rows_by_task(file_path):
+    wb = openpyxl.load_workbook(file_path, read_only=True)
     try:
-        payload = {"displayName": step_name}
-        logging.debug(f"POST {url} with payload {payload}")
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        logging.debug(f"Created step '{step_name}' at {url}. Status: {response.status_code}")
-        return response.json()
-    except Exception as e:
-        logging.error(f"Failed to create step '{step_name}' at {url}: {e}")
-        return None
+        rows_by_task = {}
+        for row in wb.active.iter_rows(min_row=2, max_col=2, values_only=True):
+            task_name, step_name = (tuple(row) + (None, None))[:2]
+            if not task_name:
+                continue
+            # A dict keeps the steps in order without duplicates
+            steps = rows_by_task.setdefault(task_name, {})
+            if step_name:
+                steps[step_name] = None
+        return {task_name: list(steps) for task_name, steps in rows_by_task.items()}
+    finally:
+        wb.close()
 
 # Main processing function
 def process_xlsx(file_path, token):
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
+    client = get_client(token)
 
     # Extract list name from file
     list_name = os.path.splitext(os.path.basename(file_path))[0]
     logging.debug(f"Processing list: {list_name}")
 
-    lists = get_todo_lists(headers)
-    list_obj = next((lst for lst in lists if lst['displayName'] == list_name), None)
+    with metrics.time("phase", "fetch"):
+        lists = get_todo_lists(client)
+        list_obj = next((lst for lst in lists if lst['displayName'] == list_name), None)
 
-    if not list_obj:
-        list_obj = create_list(list_name, headers)
         if not list_obj:
-            logging.error("Exiting due to list creation failure.")
-            return
-    list_id = list_obj['id']
-
-    tasks = get_tasks(list_id, headers)
-    task_titles = {task['title']: task for task in tasks}
-
-    wb = openpyxl.load_workbook(file_path)
-    ws = wb.active
-
-    tasks_created = 0
-    steps_created = 0
-
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        task_name, step_name = row
+            list_obj = create_list(list_name, client)
+            if not list_obj:
+                logging.error("Exiting due to list creation failure.")
+                return
+        list_id = list_obj['id']
+
+        tasks = get_tasks(list_id, client)
+        task_titles = {task['title']: task for task in tasks}
+
+    with metrics.time("phase", "read"):
+        rows_by_task = read_rows_by_task(file_path)
+
+    # Creates go out through $batch, so new tasks get their ids (and
+    # their steps get queued) only when the batch comes back.
+    writer = BatchWriter(client)
+    counts = {'tasks': 0, 'steps': 0}
+    # Step names per task id, fetched at most once per task and kept up to
+    # date as steps are queued
+    step_index = {}
+
+    def step_created(step):
+        counts['steps'] += 1
+
+    def queue_steps(task_id, step_names):
+        known = step_index.setdefault(task_id, set())
+        for step_name in step_names:
+            if step_name not in known:
+                known.add(step_name)
+                create_step(list_id, task_id, step_name, writer, step_created)
+
+    def queue_task(task_name, step_names):
+        def task_created(task_obj):
+            task_titles[task_name] = task_obj
+            counts['tasks'] += 1
+            queue_steps(task_obj['id'], step_names)
 
-        if not task_name:
-            continue
+        create_task(list_id, task_name, writer, task_created)
 
-        # Create task if not exists
-        if task_name not in task_titles:
-            task_obj = create_task(list_id, task_name, headers)
-            if not task_obj:
+    with metrics.time("phase", "create"):
+        for task_name, step_names in rows_by_task.items():
+            # Create task if not exists; its steps follow once it has an id
+            if task_name not in task_titles:
+                queue_task(task_name, step_names)
                 continue
-            task_titles[task_name] = task_obj
-            tasks_created += 1
-        task_id = task_titles[task_name]['id']
 
-        # Fetch steps
-        steps = get_steps(list_id, task_id, headers)
-        step_names = [step['displayName'] for step in steps]
+            task_id = task_titles[task_name]['id']
+            if step_names and task_id not in step_index:
+                step_index[task_id] = {step['displayName'] for step in get_steps(list_id, task_id, client)}
+            queue_steps(task_id, step_names)
 
-        # Create step if not exists
-        if step_name and step_name not in step_names:
-            if create_step(list_id, task_id, step_name, headers):
-                steps_created += 1
+        writer.flush()
+    tasks_created = counts['tasks']
+    steps_created = counts['steps']
 
     # Summary
     logging.info(f"Summary: Lists: 1, Tasks Created: {tasks_created}, Steps Created: {steps_created}")
@@ -1,28 +1,49 @@
 import os
+import sys
 import argparse
+import collections
+import contextlib
 import hashlib
-import requests
+import json
+import queue
+import re
+import shutil
 import sqlite3
-import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
 from urllib.parse import quote
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from graph_client import DEFAULT_POOL_SIZE, GraphError, get_client
+from graph_metrics import metrics
+from graph_throttle import TokenBucket
+from request_log import get_logger
+
 LOG_FILE = "onedrive_sync.log"
+logger = get_logger(LOG_FILE)
 
 
 def log_request(url, status_code=None, count=None, cloud_hash=None, local_hash=None, sql=None):
-    with open(LOG_FILE, "a") as log:
-        timestamp = datetime.utcnow().isoformat()
-        line = f"[{timestamp}] {url} - {status_code}"
-        if count is not None:
-            line += f" - Items fetched: {count}"
-        if cloud_hash:
-            line += f" - Cloud hash: {cloud_hash}"
-        if local_hash:
-            line += f" - Local hash: {local_hash}"
-        if sql:
-            line += f" - SQL: {sql}"
-        log.write(line + "\n")
+    line = f"{url} - {status_code}"
+    if count is not None:
+        line += f" - Items fetched: {count}"
+    if cloud_hash:
+        line += f" - Cloud hash: {cloud_hash}"
+    if local_hash:
+        line += f" - Local hash: {local_hash}"
+    if sql:
+        line += f" - SQL: {sql}"
+    if isinstance(status_code, int) and status_code >= 400:
+        logger.warning(line)
+    else:
+        logger.info(line)
 
 
 def read_token():
@@ -34,41 +55,53 @@ def read_token():
         raise RuntimeError("Token file (.token) not found or unreadable.")
 
 
+# Only what the sync needs; 'file' carries the hashes.
+DRIVE_ITEM_FIELDS = "id,name,size,folder,file,lastModifiedDateTime"
+
+
 def get_drive_items(token, item_id=None):
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Accept': 'application/json'
-    }
-    url = "https://graph.microsoft.com/v1.0/me/drive/root"
+    client = get_client(token)
+    url = client.url("/me/drive/root")
     if item_id:
-        url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}/children"
+        url = client.url(f"/me/drive/items/{item_id}/children")
     else:
         url += "/children"
 
     items = []
+    params = {"$select": DRIVE_ITEM_FIELDS}
     while url:
-        response = requests.get(url, headers=headers)
+        response = client.get(url, params=params)
         response.raise_for_status()
         data = response.json()
         items.extend(data['value'])
         log_request(url, response.status_code, len(data['value']))
         url = data.get('@odata.nextLink')
+        # The next link already carries the query string.
+        params = None
     return items
 
 
+def normalize_hash(value):
+    """Hashes are stored lowercase, and missing ones as NULL, so queries compare them as-is."""
+    return value.lower() if value else None
+
+
+def item_metadata(item):
+    """Return (cloud_hash, size, lastModifiedDateTime) from a listed item."""
+    cloud_hash = item.get('file', {}).get('hashes', {}).get(HASH_ALGORITHM)
+    return normalize_hash(cloud_hash), item.get('size'), item.get('lastModifiedDateTime')
+
+
 def get_cloud_hash(token, item_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Accept': 'application/json'
-    }
-    url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}"
-    response = requests.get(url, headers=headers)
+    client = get_client(token)
+    url = client.url(f"/me/drive/items/{item_id}")
+    response = client.get(url)
     cloud_hash = None
     if response.status_code == 401:
         raise Exception("Unauthorized: Check your access token")
     if response.ok:
         item = response.json()
-        cloud_hash = item.get('file', {}).get('hashes', {}).get('sha1Hash')
+        cloud_hash = normalize_hash(item.get('file', {}).get('hashes', {}).get(HASH_ALGORITHM))
     log_request(url, response.status_code, cloud_hash=cloud_hash)
     response.raise_for_status()
     return cloud_hash
@@ -80,7 +113,10 @@ download_dir = './downloaded_files'
 
 
 def init_db():
+    # Autocommit: writes are grouped with ``transaction`` where it matters.
     conn = sqlite3.connect(db_file , isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     c = conn.cursor()
     sql = '''CREATE TABLE IF NOT EXISTS files (
                 item TEXT PRIMARY KEY,
@@ -89,89 +125,865 @@ def init_db():
                 local_hash TEXT,
                 downloaded_date TEXT,
                 parent TEXT,
-                item_id TEXT
+                item_id TEXT,
+                size INTEGER,
+                cloud_modified TEXT
             )'''
     c.execute(sql)
-    log_request("init_db", 200, sql=sql)
-    conn.commit()
+    c.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    migrate_schema(conn)
     return conn
 
 
+@contextlib.contextmanager
+def transaction(conn, name="write"):
+    """Run the enclosed writes as one transaction, timed as db/``name`` in the run metrics."""
+    c = conn.cursor()
+    with metrics.time("db", name):
+        c.execute("BEGIN")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+
+
+def get_state(conn, key):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_state(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+
+# Columns added after the first release; older databases get them on open.
+ADDED_COLUMNS = [
+    ("size", "INTEGER"),
+    ("cloud_modified", "TEXT"),
+    # stat() of the local copy when local_hash was computed
+    ("local_inode", "INTEGER"),
+    ("local_size", "INTEGER"),
+    ("local_mtime", "INTEGER"),
+    # path the local copy was linked or copied from by -dedup, NULL if downloaded
+    ("local_source", "TEXT"),
+]
+
+# Indexes for the sync queries.  Each one carries the columns its queries
+# read, so those are answered from the index without touching the table.
+INDEXES = [
+    # children of a folder: walks, moves, the "already listed" check
+    ("files_parent", "parent, item_type, item_id, item"),
+    # delta and listing updates address rows by drive item id
+    ("files_item_id", "item_id, item, item_type"),
+    # files still to download
+    ("files_type", "item_type, downloaded_date, item, item_id, size"),
+    # -status
+    ("files_hashes", "item_type, cloud_hash, local_hash, local_source, size"),
+]
+
+# Bumped whenever ADDED_COLUMNS or INDEXES change; stored in PRAGMA user_version.
+SCHEMA_VERSION = 5
+
+
+def migrate_schema(conn):
+    """Bring a database created by an older version up to SCHEMA_VERSION."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    with transaction(conn, "migrate") as c:
+        c.execute("PRAGMA table_info(files)")
+        existing = {row[1] for row in c.fetchall()}
+        for name, column_type in ADDED_COLUMNS:
+            if name not in existing:
+                c.execute(f"ALTER TABLE files ADD COLUMN {name} {column_type}")
+        if version < 5:
+            # files_hashes gained columns.
+            c.execute("DROP INDEX IF EXISTS files_hashes")
+        for name, columns in INDEXES:
+            c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON files ({columns})")
+        if version < 3:
+            # Older versions stored Graph's uppercase hashes and '' for missing ones.
+            c.execute("UPDATE files SET cloud_hash = NULLIF(lower(cloud_hash), ''), local_hash = NULLIF(lower(local_hash), '')")
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    # Let the planner know how selective the new indexes are.
+    conn.execute("ANALYZE")
+    log_request("init_db", 200, sql=f"migrated schema {version} -> {SCHEMA_VERSION}")
+
+
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+
+
 def compute_hash(filepath):
+    return hash_file(hashlib.sha1(), filepath).hexdigest()
+
+
+def hash_file(hasher, filepath):
+    # hashlib drops the GIL on large updates; one reused buffer avoids an
+    # allocation per read.
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(filepath, 'rb', buffering=0) as f:
+        while n := f.readinto(buffer):
+            hasher.update(view[:n])
+    return hasher
+
+
+def file_signature(path):
+    """``(inode, size, mtime in ns)`` of ``path``, or None if it is missing."""
     try:
-        result = subprocess.run(['sha1sum', filepath], capture_output=True, text=True)
-        if result.returncode == 0:
-            return result.stdout.split()[0]
-    except Exception:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+# Connection errors retried per range, resuming from the last byte written.
+DOWNLOAD_RETRIES = 3
+# Files at least this big are split into segments when asked to.
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+
+
+# Suffixes of the files an unfinished download leaves next to its target:
+# ``.part``, the segments ``.part.<i>of<n>`` and the version ``.part.info``.
+PART_SUFFIX = re.compile(r"\.part(\.\d+of\d+|\.info)?")
+
+
+def part_files(local_path):
+    """Paths of the unfinished download files of ``local_path`` that exist."""
+    folder, name = os.path.split(local_path)
+    try:
+        entries = os.listdir(folder or '.')
+    except FileNotFoundError:
+        return []
+    return [os.path.join(folder, entry) for entry in entries
+            if entry.startswith(name) and PART_SUFFIX.fullmatch(entry[len(name):])]
+
+
+def discard_parts(local_path):
+    for path in part_files(local_path):
+        os.remove(path)
+
+
+def check_parts(local_path, size, cloud_modified):
+    """Keep the unfinished download of ``local_path`` only if it is of this version.
+
+    ``<local_path>.part.info`` records the size and modification time the
+    parts were fetched for.  Parts of another version, or of an unknown
+    one, are removed; without a cloud hash nothing else would tell their
+    bytes from the current file's.
+    """
+    info_path = local_path + ".part.info"
+    version = [size, cloud_modified]
+    try:
+        with open(info_path) as f:
+            if cloud_modified is not None and json.load(f) == version:
+                return
+    except (OSError, ValueError):
         pass
+    discard_parts(local_path)
+    with open(info_path, 'w') as f:
+        json.dump(version, f)
+
+
+class RangeIgnored(Exception):
+    """The server answered a Range request with the whole file."""
+
+
+def download_file(client, item_id, local_path, bandwidth=None, size=None, expected_hash=None, segments=1,
+                  cloud_modified=None):
+    """Download an item to local_path, resuming whatever an earlier try left.
+
+    The body goes to ``<local_path>.part``, which is kept if the download
+    fails and picked up from its last byte next time, as long as the item's
+    ``size`` and ``cloud_modified`` have not changed since.  Files of at least
+    ``SEGMENT_MIN_SIZE`` are fetched as ``segments`` parallel byte ranges
+    and joined once all are in.  The result is checked against ``size``
+    and ``expected_hash`` (the cloud hash) before it is renamed into place.
+    ``bandwidth`` is an optional byte-rate ``TokenBucket`` shared by all
+    downloads.  Returns ``(url, status_code, sha1 hex or None)``.
+    """
+    url = client.url(f"/me/drive/items/{item_id}/content")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    part_path = local_path + ".part"
+    check_parts(local_path, size, cloud_modified)
+    status, hasher = None, None
+    if segments > 1 and size and size >= SEGMENT_MIN_SIZE and not os.path.exists(part_path):
+        try:
+            status, hasher = download_segments(client, url, part_path, size, segments, bandwidth)
+        except RangeIgnored:
+            pass
+    if hasher is None and status is None:
+        status, hasher = download_stream(client, url, part_path, bandwidth)
+    if hasher is None:
+        return url, status, None
+
+    # Start from scratch next time rather than resume bad bytes.
+    received = os.path.getsize(part_path)
+    if size is not None and received != size:
+        discard_parts(local_path)
+        raise IOError(f"{local_path}: downloaded {received} bytes, expected {size}")
+    local_hash = hasher.hexdigest()
+    if expected_hash and local_hash != expected_hash:
+        discard_parts(local_path)
+        raise IOError(f"{local_path}: downloaded hash {local_hash} does not match cloud hash {expected_hash}")
+    os.replace(part_path, local_path)
+    discard_parts(local_path)
+    return url, status, local_hash
+
+
+def download_stream(client, url, part_path, bandwidth):
+    """Fetch the whole item into part_path on one connection; return (status, hasher or None)."""
     hasher = hashlib.sha1()
-    with open(filepath, 'rb') as f:
-        while chunk := f.read(8192):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+    if os.path.exists(part_path):
+        # Resuming: the bytes already on disk count towards the hash.
+        hash_file(hasher, part_path)
+    try:
+        status = fetch_range(client, url, part_path, bandwidth=bandwidth, hasher=hasher)
+    except RangeIgnored:
+        os.remove(part_path)
+        hasher = hashlib.sha1()
+        status = fetch_range(client, url, part_path, bandwidth=bandwidth, hasher=hasher)
+    return status, hasher if 200 <= status < 300 else None
+
+
+def download_segments(client, url, part_path, size, segments, bandwidth):
+    """Fetch ``segments`` byte ranges in parallel, then join them into part_path.
+
+    Each range goes to its own ``<part_path>.<i>of<n>`` file, so every
+    segment resumes on its own.  Returns (status, hasher or None).
+    """
+    step = -(-size // segments)
+    ranges = [(f"{part_path}.{i}of{segments}", start, min(start + step, size) - 1)
+              for i, start in enumerate(range(0, size, step))]
+    # Segments are kept only when the next run can resume them; once joined,
+    # or if the server ignores ranges, they are removed.
+    keep = False
+    try:
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                statuses = list(pool.map(
+                    lambda r: fetch_range(client, url, r[0], r[1], r[2], bandwidth), ranges))
+        except OSError:
+            keep = True
+            raise
+        for status in statuses:
+            if not 200 <= status < 300:
+                keep = True
+                return status, None
+        for path, start, end in ranges:
+            if os.path.getsize(path) != end - start + 1:
+                keep = True
+                raise IOError(f"{path}: segment ended early")
+
+        hasher = hashlib.sha1()
+        with open(part_path, 'wb') as out:
+            for path, _, _ in ranges:
+                with open(path, 'rb') as f:
+                    while chunk := f.read(HASH_BUFFER_SIZE):
+                        out.write(chunk)
+                        hasher.update(chunk)
+        return statuses[0], hasher
+    finally:
+        if not keep:
+            for path, _, _ in ranges:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def fetch_range(client, url, path, start=0, end=None, bandwidth=None, hasher=None):
+    """Fetch bytes ``start``..``end`` of ``url`` into ``path``.
+
+    ``end`` is inclusive; None means up to the end of the item.  Bytes that
+    ``path`` already holds are not fetched again, and a dropped connection
+    is retried from the last byte written.  ``hasher`` is updated with
+    every byte appended.  Returns the status code of the last response.
+    """
+    attempt = 0
+    while True:
+        have = os.path.getsize(path) if os.path.exists(path) else 0
+        first = start + have
+        if end is not None and first > end:
+            return 206
+        headers = {'Accept': '*/*'}
+        if first or end is not None:
+            headers['Range'] = f"bytes={first}-{'' if end is None else end}"
+        try:
+            with client.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 416 and have and end is None:
+                    # Nothing past what is already on disk.
+                    return 206
+                if not response.ok:
+                    return response.status_code
+                if 'Range' in headers and response.status_code != 206:
+                    raise RangeIgnored(url)
+                with open(path, 'ab') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        if bandwidth:
+                            bandwidth.acquire(len(chunk))
+                        f.write(chunk)
+                        if hasher:
+                            hasher.update(chunk)
+                return response.status_code
+        except OSError:
+            # requests' connection and read errors are OSErrors too.
+            if attempt >= DOWNLOAD_RETRIES:
+                raise
+            attempt += 1
+            time.sleep(2 ** attempt)
+
+
+DEFAULT_WORKERS = 4
+# Finished downloads are recorded this many to a transaction.
+WRITE_BATCH = 100
+# Files at least this big count as large for scheduling.
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+
+class DownloadQueue:
+    """Hand out downloads so small files never wait behind huge ones.
+
+    Small files go smallest first.  Large files go largest first, but only
+    to a quarter of the workers at a time (at least one) until the small
+    files run out, so the long transfers start early without blocking the
+    rest.
+    """
+
+    def __init__(self, rows, workers):
+        rows = sorted(rows, key=lambda row: row[2] or 0)
+        self.small = collections.deque(row for row in rows if (row[2] or 0) < LARGE_FILE_SIZE)
+        self.large = collections.deque(reversed([row for row in rows if (row[2] or 0) >= LARGE_FILE_SIZE]))
+        self.large_slots = max(1, workers // 4)
+        self.large_active = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        """Return ``(row, is_large)`` for the next download, or None when done."""
+        with self.lock:
+            if self.large and (self.large_active < self.large_slots or not self.small):
+                self.large_active += 1
+                return self.large.popleft(), True
+            if self.small:
+                return self.small.popleft(), False
+            return None
+
+    def done(self, is_large):
+        if is_large:
+            with self.lock:
+                self.large_active -= 1
+
 
+DEDUP_MODES = ('hardlink', 'reflink', 'copy')
+# ioctl that makes a copy-on-write clone of a whole file (Linux: btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def materialize(src, dst, mode):
+    """Create ``dst`` with the content of ``src`` as a hardlink, reflink or copy.
+
+    Falls back to a plain copy when the link cannot be made (different
+    file system, no reflink support).
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + ".part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        if mode == 'hardlink':
+            os.link(src, tmp)
+            os.replace(tmp, dst)
+            return
+        if mode == 'reflink' and fcntl:
+            with open(src, 'rb') as s, open(tmp, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            os.replace(tmp, dst)
+            return
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def plan_dedup(conn, rows, local_dir):
+    """Split download rows by content for -dedup.
+
+    Returns ``(to_download, copies, local)``: one row per distinct cloud
+    hash to download, ``{item: [items with the same hash]}`` to create from
+    it once it is in, and ``(item, source)`` pairs whose content is already
+    on disk under another path.  A local copy is only used as a source if
+    its inode, size and mtime still match the ones recorded with its hash.
+    """
+    to_download, copies, first = [], {}, {}
+    for row in rows:
+        item, cloud_hash = row[0], row[3]
+        if not cloud_hash:
+            to_download.append(row)
+        elif cloud_hash in first:
+            copies[first[cloud_hash]].append(item)
+        else:
+            first[cloud_hash] = item
+            copies[item] = []
+            to_download.append(row)
+
+    wanted = {row[0] for row in rows}
+    on_disk = {}
+    hashes = list(first)
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        c = conn.execute(f"""SELECT cloud_hash, item, local_inode, local_size, local_mtime FROM files
+                             WHERE local_hash = cloud_hash AND cloud_hash IN ({','.join('?' * len(chunk))})""", chunk)
+        for cloud_hash, item, inode, size, mtime in c.fetchall():
+            # Only a copy unchanged since it was hashed can stand in for the cloud content.
+            if item not in wanted and cloud_hash not in on_disk \
+                    and file_signature(os.path.join(local_dir, item)) == (inode, size, mtime):
+                on_disk[cloud_hash] = item
+
+    local = []
+    for cloud_hash, source in on_disk.items():
+        item = first[cloud_hash]
+        local.extend((dup, source) for dup in [item] + copies.pop(item))
+    skip = {item for item, _ in local}
+    to_download = [row for row in to_download if row[0] not in skip]
+    return to_download, copies, local
+
+
+def run_downloads(conn, token, rows, local_dir, workers=DEFAULT_WORKERS, bandwidth_limit=None, verbose=False, segments=1,
+                  dedup=None):
+    """Download ``(item, item_id, size, cloud_hash, cloud_modified)`` rows on a pool of worker threads.
+
+    Workers only transfer and hash; results come back on a queue and this
+    thread is the only one that writes to SQLite.  ``bandwidth_limit`` caps
+    the combined rate in bytes per second; ``segments`` is how many ranges
+    a large file is split into.  With ``dedup`` (one of DEDUP_MODES) each
+    distinct cloud hash is downloaded once and the other paths with that
+    hash are linked or copied from it.  Returns the number of files
+    downloaded or created.
+    """
+    client = get_client(token)
+    copies, local = {}, []
+    if dedup:
+        rows, copies, local = plan_dedup(conn, rows, local_dir)
+    bandwidth = None
+    if bandwidth_limit:
+        bandwidth = TokenBucket(bandwidth_limit, max(bandwidth_limit, DOWNLOAD_CHUNK_SIZE))
+    work = DownloadQueue(rows, workers)
+    results = queue.Queue()
+    # Set when this thread stops reading results (done, or interrupted);
+    # workers then finish the file in hand and take no more.
+    stop = threading.Event()
+
+    def copy_from(source, items, local_hash):
+        for item in items:
+            try:
+                materialize(os.path.join(local_dir, source), os.path.join(local_dir, item), dedup)
+                results.put((item, f"{dedup} from {source}", 200, local_hash, source))
+            except Exception as e:
+                results.put((item, None, None, e, None))
+
+    def worker():
+        try:
+            while not stop.is_set() and (job := work.next()) is not None:
+                (item, item_id, size, cloud_hash, cloud_modified), is_large = job
+                try:
+                    if verbose:
+                        print("File " + item, flush=True)
+                    local_path = os.path.join(local_dir, item)
+                    url, status_code, local_hash = download_file(client, item_id, local_path, bandwidth,
+                                                                 size, cloud_hash, segments, cloud_modified)
+                    results.put((item, url, status_code, local_hash, None))
+                    if local_hash:
+                        copy_from(item, copies.get(item, ()), local_hash)
+                except Exception as e:
+                    results.put((item, None, None, e, None))
+                finally:
+                    work.done(is_large)
+        finally:
+            results.put(None)
+
+    downloaded = 0
+    finished = []
+    sql = """UPDATE files SET downloaded_date = ?, local_hash = ?, local_inode = ?, local_size = ?, local_mtime = ?,
+             local_source = ? WHERE item = ?"""
+
+    def record_finished():
+        with transaction(conn, "downloads") as c:
+            c.executemany(sql, finished)
+        finished.clear()
+
+    def collect(result):
+        nonlocal downloaded
+        item, url, status_code, local_hash, source = result
+        if isinstance(local_hash, Exception):
+            print(f"Error: {local_hash}")
+        elif local_hash:
+            signature = file_signature(os.path.join(local_dir, item)) or (None, None, None)
+            finished.append((datetime.utcnow().isoformat(), local_hash) + signature + (source, item))
+            log_request(url, status_code, local_hash=local_hash)
+            downloaded += 1
+        else:
+            log_request(url, status_code)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        try:
+            # Content already on disk under another path is copied up front.
+            for item, source in local:
+                copy_from(source, [item], conn.execute("SELECT local_hash FROM files WHERE item = ?", (source,)).fetchone()[0])
+            for _ in range(max(1, workers)):
+                pool.submit(worker)
+            running = max(1, workers)
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                collect(result)
+                # Write in batches, but never sit on finished files while idle.
+                if len(finished) >= WRITE_BATCH or (finished and results.empty()):
+                    record_finished()
+        finally:
+            # Also on Ctrl-C: let the workers finish the files in hand, and
+            # record everything on disk so it is not fetched again.
+            stop.set()
+            pool.shutdown()
+            while not results.empty():
+                if (result := results.get()) is not None:
+                    collect(result)
+            if finished:
+                record_finished()
+    return downloaded
 
-def populate_db(conn, items, token, path_prefix='', parent=None):
+
+UPSERT_SQL = """INSERT INTO files (item, item_type, cloud_hash, parent, item_id, size, cloud_modified)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(item) DO UPDATE SET
+                    item_type = excluded.item_type,
+                    cloud_hash = COALESCE(excluded.cloud_hash, files.cloud_hash),
+                    parent = excluded.parent,
+                    item_id = excluded.item_id,
+                    size = excluded.size,
+                    cloud_modified = excluded.cloud_modified"""
+
+
+LIST_WORKERS = 8
+
+
+def walk_folders(token, folders, on_listed, workers=LIST_WORKERS):
+    """List folders breadth-first on a pool of ``workers`` threads.
+
+    ``folders`` are ``(item_id, rel_path)`` pairs.  Each folder's pages are
+    fetched by one worker; ``on_listed(item_id, rel_path, items)`` then runs
+    in the calling thread and returns the subfolders to list next.  Returns
+    the number of folders that could not be listed.
+    """
+    pending = collections.deque(folders)
+    in_flight = {}
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                folder_id, rel_path = pending.popleft()
+                in_flight[pool.submit(get_drive_items, token, folder_id)] = (folder_id, rel_path)
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder_id, rel_path = in_flight.pop(future)
+                try:
+                    items = future.result()
+                except Exception as e:
+                    failed += 1
+                    log_request(f"list_folder_failed_{rel_path}: {e}", 500)
+                    continue
+                pending.extend(on_listed(folder_id, rel_path, items) or ())
+    return failed
+
+
+def populate_db(conn, items, token, path_prefix='', workers=LIST_WORKERS):
+    """Record ``items`` and everything below them in the files table.
+
+    Folders are listed by ``walk_folders``; this thread is the only one
+    writing, one transaction per folder.  A folder whose children were
+    recorded on an earlier run is walked into but not listed again, so an
+    interrupted refresh carries on from where it stopped.
+    """
+    c = conn.cursor()
+
+    def unlisted(folders):
+        # Descend through folders that are already recorded.
+        to_list = []
+        stack = list(folders)
+        while stack:
+            folder_id, rel_path = stack.pop()
+            c.execute("SELECT 1 FROM files WHERE parent = ? LIMIT 1", (rel_path,))
+            if not c.fetchone():
+                to_list.append((folder_id, rel_path))
+                continue
+            log_request(f"SKIP folder already fetched: {rel_path}", 200, 0)
+            c.execute("SELECT item_id, item FROM files WHERE parent = ? AND item_type = 'folder'", (rel_path,))
+            stack.extend(c.fetchall())
+        return to_list
+
+    def record(folder_id, folder_path, items):
+        rows = []
+        subfolders = []
+        for item in items:
+            item_type = 'folder' if 'folder' in item else 'file'
+            rel_path = os.path.join(folder_path, item['name'])
+            cloud_hash, size, cloud_modified = item_metadata(item)
+            rows.append((rel_path, item_type, cloud_hash, folder_path or None, item['id'], size, cloud_modified))
+            if item_type == 'folder':
+                subfolders.append((item['id'], rel_path))
+        with transaction(conn, "populate") as tc:
+            tc.executemany(UPSERT_SQL, rows)
+        log_request(f"populate_db {folder_path or '/'}", 200, len(rows))
+        return unlisted(subfolders)
+
+    failed = walk_folders(token, record(None, path_prefix, items), record, workers)
+    if failed:
+        print(f"{failed} folders could not be listed; run -refresh_list again to retry them.")
+
+
+DELTA_ITEM_FIELDS = DRIVE_ITEM_FIELDS + ",parentReference,deleted,root"
+
+
+def refresh_file_list(conn, token, local_dir, workers=LIST_WORKERS):
+    """Bring the files table up to date from the drive's delta feed.
+
+    The first run enumerates the whole drive; later runs start from the
+    deltaLink saved in sync_state and only see what changed since.  If the
+    delta feed cannot be used at all, fall back to walking the tree.
+    Downloaded copies under ``local_dir`` follow their items' moves.
+    """
+    print("Refreshing file list from OneDrive...")
+    try:
+        apply_drive_delta(conn, token, get_state(conn, 'delta_link'), local_dir)
+    except GraphError as e:
+        if e.status_code != 410:
+            print(f"Delta query failed ({e.status_code}); walking the whole drive instead.")
+            populate_db(conn, get_drive_items(token), token, workers=workers)
+            return
+        # The saved token expired: enumerate again and drop whatever is gone.
+        print("Delta token expired; re-enumerating the drive.")
+        apply_drive_delta(conn, token, None, local_dir)
+
+
+def apply_drive_delta(conn, token, delta_link, local_dir):
+    """Apply one delta round to the files table, a page per transaction.
+
+    Without ``delta_link`` the round lists every item; rows whose item was
+    not listed are then deleted, which also clears out anything left over
+    from a tree walk or an expired token.
+    """
+    client = get_client(token)
     c = conn.cursor()
+    full = delta_link is None
+    if full:
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS delta_seen (item_id TEXT PRIMARY KEY)")
+        c.execute("DELETE FROM delta_seen")
+    root_id = get_state(conn, 'root_id')
+    # Items whose parent has not been placed yet, retried after each page.
+    unplaced = []
+    next_link = None
+    url = delta_link or "/me/drive/root/delta"
+    params = None if delta_link else {"$select": DELTA_ITEM_FIELDS}
+    changed = removed = 0
+
+    for page in client.iter_pages(url, page_size=0, params=params):
+        items = page.get('value', [])
+        log_request(url, 200, len(items))
+        with transaction(conn, "delta") as c:
+            for item in items:
+                if 'root' in item:
+                    root_id = item['id']
+                    set_state(conn, 'root_id', root_id)
+            if full:
+                c.executemany("INSERT OR IGNORE INTO delta_seen (item_id) VALUES (?)", [(item['id'],) for item in items])
+            unplaced, page_changed, page_removed = apply_delta_items(c, unplaced + items, root_id, local_dir)
+        changed += page_changed
+        removed += page_removed
+        next_link = page.get('@odata.deltaLink', next_link)
+
+    with transaction(conn, "delta") as c:
+        unplaced, late_changed, _ = apply_delta_items(c, unplaced, root_id, local_dir)
+        changed += late_changed
+        for item in unplaced:
+            log_request(f"delta: parent of {item.get('name')} ({item['id']}) never listed", 404)
+        if full:
+            c.execute("DELETE FROM files WHERE item_id IS NOT NULL AND item_id NOT IN (SELECT item_id FROM delta_seen)")
+            removed += c.rowcount
+        if next_link:
+            set_state(conn, 'delta_link', next_link)
+    print(f"Applied {changed} added or changed items and {removed} removals.")
+
+
+def apply_delta_items(c, items, root_id, local_dir):
+    """Apply delta items; return (items whose parent is unknown, changed, removed)."""
+    ids = {item['id'] for item in items} | {item.get('parentReference', {}).get('id') for item in items}
+    ids.discard(None)
+    # item_id -> (path, type) for every row this page touches
+    known = {}
+    id_list = list(ids)
+    for start in range(0, len(id_list), 500):
+        chunk = id_list[start:start + 500]
+        c.execute(f"SELECT item_id, item, item_type FROM files WHERE item_id IN ({','.join('?' * len(chunk))})", chunk)
+        known.update((item_id, (path, item_type)) for item_id, path, item_type in c.fetchall())
+
+    upserts = []
+    unplaced = []
+    changed = removed = 0
+
+    def flush_upserts():
+        c.executemany(UPSERT_SQL, upserts)
+        upserts.clear()
+
     for item in items:
-        name = item['name']
         item_id = item['id']
-        item_type = 'folder' if 'folder' in item else 'file'
-        rel_path = os.path.join(path_prefix, name)
+        if 'root' in item:
+            continue
+        if 'deleted' in item:
+            if item_id in known:
+                flush_upserts()
+                delete_tree(c, known.pop(item_id)[0])
+                removed += 1
+            continue
 
-        c.execute("SELECT 1 FROM files WHERE item = ?", (rel_path,))
-        if c.fetchone():
+        parent_id = item.get('parentReference', {}).get('id')
+        if parent_id == root_id:
+            parent_path = None
+        elif parent_id in known:
+            parent_path = known[parent_id][0]
+        else:
+            unplaced.append(item)
             continue
+        item_type = 'folder' if 'folder' in item else 'file'
+        rel_path = os.path.join(parent_path or '', item['name'])
 
-        cloud_hash = None
-        sql = "INSERT OR IGNORE INTO files (item, item_type, cloud_hash, local_hash, downloaded_date, parent, item_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
-        c.execute(sql, (rel_path, item_type, cloud_hash, None, None, parent, item_id))
-        log_request("populate_db", 200, sql=sql)
+        old_path = known.get(item_id, (None, None))[0]
+        if old_path is not None and old_path != rel_path:
+            # Renamed or moved: carry the row, and for folders everything under it.
+            flush_upserts()
+            move_tree(c, old_path, rel_path, local_dir)
+            # Later items in this batch must find the moved rows at their new paths.
+            low, high = subtree_range(old_path)
+            for other_id, (path, other_type) in known.items():
+                if low <= path < high:
+                    known[other_id] = (rel_path + path[len(old_path):], other_type)
+        known[item_id] = (rel_path, item_type)
+        cloud_hash, size, cloud_modified = item_metadata(item)
+        upserts.append((rel_path, item_type, cloud_hash, parent_path, item_id, size, cloud_modified))
+        changed += 1
+    flush_upserts()
+    return unplaced, changed, removed
 
-        if item_type == 'folder':
-            c.execute("SELECT 1 FROM files WHERE parent = ? LIMIT 1", (rel_path,))
-            if c.fetchone():
-                log_request(f"SKIP folder already fetched: {rel_path}", 200, 0)
-                continue
-            sub_items = get_drive_items(token, item_id)
-            populate_db(conn, sub_items, token, rel_path, parent=rel_path)
-    conn.commit()
 
+def subtree_range(path):
+    """Bounds ``(low, high)`` such that ``low <= p < high`` for every path below ``path``.
+
+    Range comparisons can use the item and parent indexes; prefix
+    matching with substr() or LIKE cannot.
+    """
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+def delete_tree(c, path):
+    c.execute("DELETE FROM files WHERE item = ?", (path,))
+    c.execute("DELETE FROM files WHERE item >= ? AND item < ?", subtree_range(path))
 
-def refresh_file_list(conn, token):
-    print("Refreshing file list from OneDrive...")
-    items = get_drive_items(token)
-    populate_db(conn, items, token)
+
+def move_tree(c, old_path, new_path, local_dir):
+    low, high = subtree_range(old_path)
+    new_prefix = new_path + os.sep
+    # Whatever sat at the destination is being replaced.
+    delete_tree(c, new_path)
+    c.execute("UPDATE files SET item = ? WHERE item = ?", (new_path, old_path))
+    c.execute("UPDATE files SET item = ? || substr(item, ?) WHERE item >= ? AND item < ?",
+              (new_prefix, len(low) + 1, low, high))
+    c.execute("UPDATE files SET parent = ? WHERE parent = ?", (new_path, old_path))
+    c.execute("UPDATE files SET parent = ? || substr(parent, ?) WHERE parent >= ? AND parent < ?",
+              (new_prefix, len(low) + 1, low, high))
+    move_local(c, old_path, new_path, local_dir)
+
+
+def move_local(c, old_path, new_path, local_dir):
+    """Move the downloaded copy of a moved item, or forget it if that fails.
+
+    The rows keep their local hashes and download dates, so the copy has
+    to be where they now point.  An unfinished download (``.part`` and its
+    segments) moves too, so it can still resume.  If anything cannot be
+    moved, the rows are marked as not downloaded and the next download
+    fetches them again.
+    """
+    old_local = os.path.join(local_dir, old_path)
+    new_local = os.path.join(local_dir, new_path)
+    moves = [(path, new_local + path[len(old_local):]) for path in part_files(old_local)]
+    if os.path.lexists(old_local):
+        moves.insert(0, (old_local, new_local))
+    if not moves:
+        return
+    try:
+        os.makedirs(os.path.dirname(new_local), exist_ok=True)
+        for src, dst in moves:
+            os.replace(src, dst)
+    except OSError as e:
+        print(f"Could not move {old_local} to {new_local}: {e}")
+        forget = """UPDATE files SET local_hash = NULL, downloaded_date = NULL, local_inode = NULL,
+                    local_size = NULL, local_mtime = NULL, local_source = NULL WHERE """
+        c.execute(forget + "item = ?", (new_path,))
+        c.execute(forget + "item >= ? AND item < ?", subtree_range(new_path))
 
 
 def get_missing_cloud_hash(conn, token):
+    """Fallback for files the folder listings gave no hash for: one GET per file."""
     c = conn.cursor()
     c.execute("SELECT item, item_id FROM files WHERE item_type = 'file' AND (cloud_hash IS NULL OR cloud_hash = '') AND item_id IS NOT NULL")
     rows = c.fetchall()
+    found = []
+    saved = 0
+
+    def save():
+        with transaction(conn, "cloud_hash") as c:
+            c.executemany("UPDATE files SET cloud_hash = ? WHERE item = ?", found)
+        found.clear()
+
     for item, item_id in rows:
         try:
-            cloud_hash = get_cloud_hash(token, item_id)
-            sql = "UPDATE files SET cloud_hash = ? WHERE item = ?"
-            c.execute(sql, (cloud_hash, item))
-            log_request("get_missing_cloud_hash", 200, cloud_hash=cloud_hash, sql=sql)
+            found.append((get_cloud_hash(token, item_id), item))
         except Exception as e:
             log_request(f"get_missing_cloud_hash_failed_{item_id}", 500, cloud_hash="ERROR")
-    conn.commit()
+            continue
+        saved += 1
+        # Commit as we go so an interrupted run keeps what it fetched.
+        if len(found) >= WRITE_BATCH:
+            save()
+    save()
+    log_request("get_missing_cloud_hash", 200, count=saved)
+
 
+def harvest_cloud_hashes(conn, token, workers=LIST_WORKERS):
+    """Refresh hash, size and modified time of every known file from the folder listings.
 
-def update_cloud_hash(conn, token):
+    One children listing covers a whole folder, instead of one item GET per file.
+    """
     c = conn.cursor()
-    c.execute("SELECT item, item_id FROM files WHERE item_type = 'file' AND item_id IS NOT NULL")
-    rows = c.fetchall()
-    for item, item_id in rows:
-        try:
-            cloud_hash = get_cloud_hash(token, item_id)
-            sql = "UPDATE files SET cloud_hash = ? WHERE item = ?"
-            c.execute(sql, (cloud_hash, item))
-            log_request("update_cloud_hash", 200, cloud_hash=cloud_hash, sql=sql)
-        except Exception as e:
-            log_request(f"update_cloud_hash_failed_{item_id}", 500, cloud_hash="ERROR")
-    conn.commit()
+    c.execute("SELECT item_id, item FROM files WHERE item_type = 'folder' AND item_id IS NOT NULL")
+    folders = [(None, '')] + c.fetchall()
+    sql = "UPDATE files SET cloud_hash = ?, size = ?, cloud_modified = ? WHERE item_id = ?"
+
+    def record(folder_id, rel_path, items):
+        rows = [item_metadata(item) + (item['id'],) for item in items if 'file' in item]
+        with transaction(conn, "cloud_hash") as tc:
+            tc.executemany(sql, rows)
+        log_request(f"harvest_cloud_hashes {rel_path or '/'}", 200, count=len(rows))
+
+    walk_folders(token, folders, record, workers)
+
+
+def update_cloud_hash(conn, token, workers=LIST_WORKERS):
+    harvest_cloud_hashes(conn, token, workers)
+    get_missing_cloud_hash(conn, token)
 
 
 def check_updates(conn, local_dir):
@@ -186,143 +998,94 @@ def check_updates(conn, local_dir):
         print(f"UPDATE NEEDED: {item}")
 
 
-def download_updates(conn, token, local_dir):
+def download_updates(conn, token, local_dir, workers=DEFAULT_WORKERS, bandwidth_limit=None, segments=1, dedup=None):
     c = conn.cursor()
-    c.execute("SELECT item, item_id FROM files WHERE item_type = 'file' AND ( lower(cloud_hash) != lower(local_hash) or local_hash IS NULL ) ")
-    updated = 0
-    for item, item_id in c.fetchall():
-      try:
-        local_path = os.path.join(local_dir, item)
-        print("File " + item,flush=True)
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}/content"
-        response = requests.get(url, headers={'Authorization': f'Bearer {token}'})
-        if response.ok:
-            with open(local_path, 'wb') as f:
-                f.write(response.content)
-            downloaded_date = datetime.utcnow().isoformat()
-            local_hash = compute_hash(local_path)
-            sql = "UPDATE files SET downloaded_date = ?, local_hash = ? WHERE item = ?"
-            c.execute(sql, (downloaded_date, local_hash, item))
-            log_request(url, response.status_code, cloud_hash="UPDATED", local_hash=local_hash, sql=sql)
-            updated += 1
-        else:
-            log_request(url, response.status_code )
-      except Exception as e:
-        print(f"Error: {e}")
-
-    conn.commit()
+    c.execute("SELECT item, item_id, size, cloud_hash, cloud_modified FROM files WHERE item_type = 'file' AND ( cloud_hash != local_hash or local_hash IS NULL ) ")
+    updated = run_downloads(conn, token, c.fetchall(), local_dir, workers, bandwidth_limit, verbose=True, segments=segments,
+                            dedup=dedup)
     print(f"Downloaded and updated {updated} files.")
 
 
-def sync_downloads(conn, token, local_dir):
+def sync_downloads(conn, token, local_dir, workers=DEFAULT_WORKERS, bandwidth_limit=None, segments=1, dedup=None):
     c = conn.cursor()
-    c.execute("SELECT item, item_id FROM files WHERE item_type = 'file' AND downloaded_date IS NULL")
-    downloaded = 0
-    for item, item_id in c.fetchall():
-        local_path = os.path.join(local_dir, item)
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}/content"
-        response = requests.get(url, headers={'Authorization': f'Bearer {token}'})
-        if response.ok:
-            with open(local_path, 'wb') as f:
-                f.write(response.content)
-            downloaded_date = datetime.utcnow().isoformat()
-            local_hash = compute_hash(local_path)
-            sql = "UPDATE files SET downloaded_date = ?, local_hash = ? WHERE item = ?"
-            c.execute(sql, (downloaded_date, local_hash, item))
-            log_request(url, response.status_code, local_hash=local_hash, sql=sql)
-            downloaded += 1
-        else:
-            log_request(url, response.status_code)
-
-    conn.commit()
+    c.execute("SELECT item, item_id, size, cloud_hash, cloud_modified FROM files WHERE item_type = 'file' AND downloaded_date IS NULL")
+    downloaded = run_downloads(conn, token, c.fetchall(), local_dir, workers, bandwidth_limit, segments=segments,
+                               dedup=dedup)
     print(f"Downloaded {downloaded} new files.")
 
 
-def update_local_hash(conn, local_dir):
-    c = conn.cursor()
-    c.execute("SELECT item FROM files WHERE item_type = 'file'")
-    updated = 0
-    for (item,) in c.fetchall():
-        local_path = os.path.join(local_dir, item)
-        if os.path.exists(local_path):
-            local_hash = compute_hash(local_path)
-            sql = "UPDATE files SET local_hash = ? WHERE item = ?"
-            c.execute(sql, (local_hash, item))
-            log_request("update_local_hash", 200, local_hash=local_hash, sql=sql)
-            updated += 1
-    conn.commit()
-    print(f"Updated local hash for {updated} files.")
-
-
-def find_diff_summary(conn):
-    c = conn.cursor()
+# Local hashes are written this many to a transaction.
+HASH_WRITE_BATCH = 500
 
-    c.execute("""
-        SELECT COUNT(*) FROM files
-        WHERE item_type = 'file'
-        AND cloud_hash IS NOT NULL AND cloud_hash != ''
-        AND local_hash IS NOT NULL AND local_hash != ''
-        AND lower(cloud_hash) = lower(local_hash)
-    """)
-    same = c.fetchone()[0]
 
-    c.execute("""
-        SELECT COUNT(*) FROM files
-        WHERE item_type = 'file'
-        AND cloud_hash IS NOT NULL AND cloud_hash != ''
-        AND local_hash IS NOT NULL AND local_hash != ''
-        AND lower(cloud_hash) != lower(local_hash)
-    """)
-    different = c.fetchone()[0]
+def update_local_hash(conn, local_dir, workers=None):
+    """Hash local copies whose inode, size or mtime changed since they were last hashed.
 
-    c.execute("""
-        SELECT item FROM files
-        WHERE item_type = 'file'
-        AND (cloud_hash IS NULL OR cloud_hash = '')
-    """)
-    missing_cloud = [row[0] for row in c.fetchall()]
+    Unchanged files cost one stat() each.  The rest are hashed on a pool of
+    ``workers`` processes (one per CPU by default).
+    """
+    c = conn.cursor()
+    c.execute("SELECT item, local_hash, local_inode, local_size, local_mtime FROM files WHERE item_type = 'file'")
+    stale = []
+    unchanged = 0
+    for item, local_hash, *cached in c.fetchall():
+        signature = file_signature(os.path.join(local_dir, item))
+        if signature is None:
+            continue
+        if local_hash and tuple(cached) == signature:
+            unchanged += 1
+            continue
+        stale.append((item, signature))
 
-    c.execute("""
-        SELECT item FROM files
-        WHERE item_type = 'file'
-        AND (local_hash IS NULL OR local_hash = '')
-    """)
-    missing_local = [row[0] for row in c.fetchall()]
+    updated = 0
+    sql = "UPDATE files SET local_hash = ?, local_inode = ?, local_size = ?, local_mtime = ? WHERE item = ?"
+    paths = [os.path.join(local_dir, item) for item, _ in stale]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(compute_hash, paths, chunksize=8)
+        rows = []
+        for (item, signature), local_hash in zip(stale, hashes):
+            rows.append((local_hash,) + signature + (item,))
+            if len(rows) >= HASH_WRITE_BATCH:
+                with transaction(conn, "local_hash") as tc:
+                    tc.executemany(sql, rows)
+                updated += len(rows)
+                rows.clear()
+        with transaction(conn, "local_hash") as tc:
+            tc.executemany(sql, rows)
+        updated += len(rows)
+    log_request("update_local_hash", 200, count=updated)
+    print(f"Updated local hash for {updated} files ({unchanged} unchanged).")
 
-    c.execute("""
-        SELECT COUNT(*) FROM files
-        WHERE item_type = 'file'
-        AND cloud_hash IS NOT NULL AND cloud_hash != ''
-        AND (local_hash IS NULL OR local_hash = '')
-    """)
-    cloud_only = c.fetchone()[0]
 
+def find_diff_summary(conn):
+    # One pass over the files_hashes index.  Hashes are normalized when
+    # written, so plain comparisons do and NULL means missing.
+    c = conn.cursor()
     c.execute("""
-        SELECT COUNT(*) FROM files
+        SELECT
+            TOTAL(cloud_hash = local_hash),
+            TOTAL(cloud_hash != local_hash),
+            TOTAL(cloud_hash IS NULL),
+            TOTAL(local_hash IS NULL),
+            TOTAL(cloud_hash IS NOT NULL AND local_hash IS NULL),
+            TOTAL(local_hash IS NOT NULL AND cloud_hash IS NULL),
+            TOTAL(CASE WHEN local_source IS NOT NULL THEN size END)
+        FROM files
         WHERE item_type = 'file'
-        AND local_hash IS NOT NULL AND local_hash != ''
-        AND (cloud_hash IS NULL OR cloud_hash = '')
     """)
-    local_only = c.fetchone()[0]
+    same, different, missing_cloud, missing_local, cloud_only, local_only, dedup_saved = (int(n) for n in c.fetchone())
 
     print("Summary of hash comparison:")
     print(f"  Same cloud/local hash: {same}")
     print(f"  Different cloud/local hash: {different}")
-    print(f"  Files missing cloud hash ({len(missing_cloud)}):")
-    print(f"  Files missing local hash ({len(missing_local)}):")
+    print(f"  Files missing cloud hash ({missing_cloud}):")
+    print(f"  Files missing local hash ({missing_local}):")
     print(f"  Cloud hash only : {cloud_only}")
     print(f"  Local hash only : {local_only}")
-
-
-    #for item in missing_cloud:
-        #print(f"    - {item}")
-    #for item in missing_local:
-        #print(f"    - {item}")
+    print(f"  Saved by dedup  : {dedup_saved} bytes ({dedup_saved / (1024 * 1024):.1f} MiB)")
 
     log_request("summary", 200, count=same + different,
-                sql=f"same={same}, different={different}, missing_cloud={len(missing_cloud)}, missing_local={len(missing_local)}")
+                sql=f"same={same}, different={different}, missing_cloud={missing_cloud}, missing_local={missing_local}")
 
 
 if __name__ == '__main__':
@@ -336,42 +1099,61 @@ if __name__ == '__main__':
     parser.add_argument('-sync_all', action='store_true')
     parser.add_argument('-status', action='store_true')
     parser.add_argument('-local_dir', type=str, default='./downloaded_files')
+    parser.add_argument('-workers', type=int, default=DEFAULT_WORKERS, help='Parallel downloads')
+    parser.add_argument('-list_workers', type=int, default=LIST_WORKERS, help='Folders listed in parallel')
+    parser.add_argument('-segments', type=int, default=1, help='Parallel byte ranges per large file (1 = off)')
+    parser.add_argument('-dedup', choices=DEDUP_MODES, help='Download each distinct cloud hash once; link or copy the other paths')
+    parser.add_argument('-max_mbps', type=float, default=0, help='Cap on combined download rate in MB/s (0 = no cap)')
     args = parser.parse_args()
 
     token = read_token()
+    get_client(token, pool_size=max(args.workers * max(1, args.segments), args.list_workers, DEFAULT_POOL_SIZE))
+    bandwidth_limit = int(args.max_mbps * 1024 * 1024) or None
     conn = init_db()
     download_dir = args.local_dir
 
     try:
         if args.refresh_list:
-            refresh_file_list(conn, token)
+            with metrics.time("phase", "refresh_list"):
+                refresh_file_list(conn, token, download_dir, args.list_workers)
         elif args.update_cloud_hash:
             print("Updating cloud hashes...")
-            update_cloud_hash(conn, token)
+            with metrics.time("phase", "update_cloud_hash"):
+                update_cloud_hash(conn, token, args.list_workers)
         elif args.get_cloud_hash:
             print("Updating missing cloud hashes...")
-            get_missing_cloud_hash(conn, token)
+            with metrics.time("phase", "get_cloud_hash"):
+                get_missing_cloud_hash(conn, token)
         elif args.check_updates:
             print("Checking for file updates...")
-            check_updates(conn, download_dir)
+            with metrics.time("phase", "check_updates"):
+                check_updates(conn, download_dir)
         elif args.download_updates:
             print("Downloading updated files...")
-            download_updates(conn, token, download_dir)
+            with metrics.time("phase", "download_updates"):
+                download_updates(conn, token, download_dir, args.workers, bandwidth_limit, args.segments, args.dedup)
         elif args.update_local_hash:
             print("Updating local hashes for present files...")
-            update_local_hash(conn, download_dir)
+            with metrics.time("phase", "update_local_hash"):
+                update_local_hash(conn, download_dir)
         elif args.status:
             print("Comparing cloud and local hashes...")
-            find_diff_summary(conn)
+            with metrics.time("phase", "status"):
+                find_diff_summary(conn)
         elif args.sync_all:
             print("Running full sync (refresh list, get cloud hash, update local hash, download updates)...")
-            refresh_file_list(conn, token)
-            get_missing_cloud_hash(conn, token)
-            update_local_hash(conn, download_dir)
-            download_updates(conn, token, download_dir)
+            with metrics.time("phase", "refresh_list"):
+                refresh_file_list(conn, token, download_dir, args.list_workers)
+            with metrics.time("phase", "get_cloud_hash"):
+                get_missing_cloud_hash(conn, token)
+            with metrics.time("phase", "update_local_hash"):
+                update_local_hash(conn, download_dir)
+            with metrics.time("phase", "download_updates"):
+                download_updates(conn, token, download_dir, args.workers, bandwidth_limit, args.segments, args.dedup)
         else:
             print("Performing initial file download...")
-            sync_downloads(conn, token, download_dir)
+            with metrics.time("phase", "sync_downloads"):
+                sync_downloads(conn, token, download_dir, args.workers, bandwidth_limit, args.segments, args.dedup)
     except Exception as e:
         print(f"Error: {e}")
 
@@ -1,16 +1,61 @@
-import requests
+import os
 import pandas as pd
 from openpyxl import Workbook, load_workbook
 import json
 import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-def log_request(url, status_code, response_text):
-    """Logs API requests with their status codes and responses to a log file."""
-    with open("request_log.txt", "a") as log_file:
-        log_file.write(f"URL: {url} | Status: {status_code} | Response: {response_text}\n")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from graph_client import DEFAULT_POOL_SIZE, GraphError, get_client, limiter
+from graph_metrics import metrics
+import request_log
 
-def get_todo_data(token_file):
+DEFAULT_CONCURRENCY = 8
+
+request_logger = request_log.get_logger("request_log.txt")
+
+def log_response(response):
+    """Logs API requests with their status codes, and the response body on errors."""
+    request_log.log_response(request_logger, response)
+
+def get_list_rows(client, lst):
+    """Returns the rows for one list: the list itself, its tasks and their steps.
+
+    Tasks come back with their checklist items expanded, one call per page of
+    tasks. If the expanded query fails the list is read again task by task.
+    """
+    list_name = lst.get('displayName', 'Unnamed List')
+    list_id = lst.get('id', '')
+    tasks_url = f"/me/todo/lists/{list_id}/tasks"
+    try:
+        rows = [(list_name, "", "")]  # List level
+        for task in client.iter_items(tasks_url, params={"$expand": "checklistItems"}, on_response=log_response):
+            rows.append(("", task.get('title', 'Unnamed Task'), ""))  # task level
+            for step in task.get("checklistItems", []):
+                rows.append(("", "", step.get('displayName', 'Unnamed Step')))  # Step as separate row
+        return rows
+    except GraphError:
+        pass
+
+    rows = [(list_name, "", "")]
+    try:
+        for task in client.iter_items(tasks_url, on_response=log_response):
+            rows.append(("", task.get('title', 'Unnamed Task'), ""))
+            task_id = task.get('id', '')
+            if not task_id:
+                continue
+            checklist_url = f"{tasks_url}/{task_id}/checklistItems"
+            try:
+                for step in client.iter_items(checklist_url, on_response=log_response):
+                    rows.append(("", "", step.get('displayName', 'Unnamed Step')))
+            except GraphError as e:
+                rows.append(("", "", f"Error fetching steps: {e.status_code} {e.response.text}"))
+    except GraphError:
+        pass
+    return rows
+
+def get_todo_data(token_file, concurrency=DEFAULT_CONCURRENCY):
     """Fetches all tasks from Microsoft To Do including checklist items (steps), excluding status, with progress updates."""
     try:
         with open(token_file, 'r') as file:
@@ -18,55 +63,21 @@ def get_todo_data(token_file):
     except FileNotFoundError:
         raise Exception("Token file not found.")
     
-    headers = {"Authorization": f"Bearer {token}"}
-    lists_url = "https://graph.microsoft.com/v1.0/me/todo/lists"
-    response = requests.get(lists_url, headers=headers)
-    log_request(lists_url, response.status_code, response.text)
-    
-    if response.status_code != 200:
-        raise Exception(f"Error fetching lists: {response.text}")
+    client = get_client(token, pool_size=max(concurrency, DEFAULT_POOL_SIZE))
+    try:
+        lists = list(client.iter_items("/me/todo/lists", on_response=log_response))
+    except GraphError as e:
+        raise Exception(f"Error fetching lists: {e.response.text}")
     
-    lists = response.json().get("value", [])
     data = []
     total_lists = len(lists)
     
-    for index, lst in enumerate(lists, start=1):
-        list_name = lst.get('displayName', 'Unnamed List')
-        list_id = lst.get('id', '')
-        data.append((list_name, "", ""))  # List level
-        
-        tasks_url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks"
-        task_response = requests.get(tasks_url, headers=headers)
-        log_request(tasks_url, task_response.status_code, task_response.text)
-        
-        if task_response.status_code != 200:
-            continue
-        
-        tasks = task_response.json().get("value", [])
-        total_tasks = len(tasks)
-        
-        for task_index, task in enumerate(tasks, start=1):
-            task_name = task.get('title', 'Unnamed Task')
-            steps_text = ""
-            data.append(("", task_name, ""))  # task level
-            task_id = task.get('id', '')
-            
-            if task_id:
-                checklist_url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks/{task_id}/checklistItems"
-                checklist_response = requests.get(checklist_url, headers=headers)
-                log_request(checklist_url, checklist_response.status_code, checklist_response.text)
-                
-
-                if checklist_response.status_code == 200:
-                    checklist_items = checklist_response.json().get("value", [])
-                    for step in checklist_items:
-                        step_name = step.get('displayName', 'Unnamed Step')
-                        data.append(("", "", step_name))  # Step as separate row
-                else:
-                    data.append(("", "", f"Error fetching steps: {checklist_response.status_code} {checklist_response.text}"))
-           
+    # Lists are read in parallel; map() returns them in the original order.
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for index, rows in enumerate(pool.map(lambda lst: get_list_rows(client, lst), lists), start=1):
+            data.extend(rows)
             # Print progress update dynamically
-            sys.stdout.write(f"\rProcessing list {index}/{total_lists}, task {task_index}/{total_tasks} completed  ")
+            sys.stdout.write(f"\rProcessing list {index}/{total_lists} completed ({limiter.describe()})  ")
             sys.stdout.flush()
     
     print("\nData retrieval completed.")
@@ -86,13 +97,16 @@ def main():
     parser.add_argument("action", choices=["import"], help="Action to perform")
     parser.add_argument("--file", required=True, help="Excel filename")
     parser.add_argument("--token", required=True, help="Token filename")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Number of lists to read at once")
     
     args = parser.parse_args()
     
     try:
         if args.action == "import":
-            data = get_todo_data(args.token)
-            export_to_excel(data, args.file)
+            with metrics.time("phase", "fetch"):
+                data = get_todo_data(args.token, args.concurrency)
+            with metrics.time("phase", "write_excel"):
+                export_to_excel(data, args.file)
     except Exception as e:
         print(f"Error: {str(e)}")
 
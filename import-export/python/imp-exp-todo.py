@@ -1,6 +1,17 @@
-import requests
 import json
 import argparse
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+from graph_batch import BatchWriter
+from graph_client import DEFAULT_POOL_SIZE, GraphError, get_client
+from graph_metrics import metrics
+from import_journal import ImportJournal, task_kind
+from todo_export import is_ndjson_name, iter_records, write_index, write_record
 
 def get_access_token():
     try:
@@ -10,85 +21,314 @@ def get_access_token():
         print("Error: Token file 'token.txt' not found. Please create the file and add your OAuth2 token.")
         exit(1)
 
-def fetch_todo_lists(access_token):
-    url = "https://graph.microsoft.com/v1.0/me/todo/lists"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        lists = response.json()
-        for todo_list in lists.get("value", []):
-            list_id = todo_list["id"]
-            todo_list["tasks"] = fetch_tasks(access_token, list_id)
+DEFAULT_CONCURRENCY = 8
+# Pages of tasks each list may buffer while an earlier list is being written.
+PAGES_IN_FLIGHT = 4
+
+def fetch_list_envelope(access_token):
+    """Fetch every list, without tasks, as one {"@odata.context", "value"} dict."""
+    try:
+        pages = get_client(access_token).iter_pages("/me/todo/lists")
+        # Keep the first page's envelope (@odata.context) and fold the rest in.
+        lists = next(pages)
+        lists.pop("@odata.nextLink", None)
+        for page in pages:
+            lists["value"].extend(page.get("value", []))
         return lists
-    else:
-        print(f"Error fetching lists: {response.status_code}, {response.text}")
+    except GraphError as e:
+        print(f"Error fetching lists: {e}")
+        return None
+
+def fetch_todo_lists(access_token, concurrency=DEFAULT_CONCURRENCY):
+    lists = fetch_list_envelope(access_token)
+    if lists is None:
         return None
+    # Lists are fetched in parallel; pool.map hands results back in list
+    # order, so the export is identical to a serial run.
+    todo_lists = lists.get("value", [])
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        all_tasks = pool.map(lambda todo_list: fetch_tasks(access_token, todo_list["id"]), todo_lists)
+        for todo_list, tasks in zip(todo_lists, all_tasks):
+            todo_list["tasks"] = tasks
+    return lists
+
+def iter_tasks(access_token, list_id):
+    """Yield the tasks of a list page by page as they arrive."""
+    try:
+        yield from get_client(access_token).iter_items(f"/me/todo/lists/{list_id}/tasks")
+    except GraphError as e:
+        print(f"Error fetching tasks for list {list_id}: {e}")
 
 def fetch_tasks(access_token, list_id):
-    url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json().get("value", [])
-    else:
-        print(f"Error fetching tasks for list {list_id}: {response.status_code}, {response.text}")
-        return []
+    return list(iter_tasks(access_token, list_id))
+
+def fetch_task_changes(access_token, list_id, delta_link=None):
+    """Read a list's task delta: (changed tasks, removed ids, next deltaLink, full).
+
+    Without a ``delta_link`` this starts a new delta round, which returns
+    every task; ``full`` is then True and the changed tasks are the whole
+    list. An expired ``delta_link`` also starts over. Returns None if the
+    delta cannot be read.
+    """
+    url = delta_link or f"/me/todo/lists/{list_id}/tasks/delta"
+    changed, removed, next_link = [], [], None
+    try:
+        for page in get_client(access_token).iter_pages(url, page_size=0):
+            for task in page.get("value", []):
+                if "@removed" in task:
+                    removed.append(task["id"])
+                else:
+                    changed.append(task)
+            next_link = page.get("@odata.deltaLink", next_link)
+    except GraphError as e:
+        if delta_link and e.status_code in (400, 404, 410):
+            # The delta token expired; start the list over.
+            return fetch_task_changes(access_token, list_id)
+        print(f"Error fetching task changes for list {list_id}: {e}")
+        return None
+    return changed, removed, next_link, delta_link is None
+
+def merge_tasks(tasks, changed, removed):
+    """Apply a task delta to an exported task list, keeping its order."""
+    position = {task["id"]: i for i, task in enumerate(tasks)}
+    tasks = list(tasks)
+    for task in changed:
+        if task["id"] in position:
+            tasks[position[task["id"]]] = task
+        else:
+            position[task["id"]] = len(tasks)
+            tasks.append(task)
+    removed = set(removed)
+    return [task for task in tasks if task["id"] not in removed]
+
+def delta_state_filename(filename):
+    return f"{filename}.delta.json"
+
+def export_incremental(access_token, filename, concurrency=DEFAULT_CONCURRENCY):
+    """Refresh an existing export with only the tasks changed since the last run.
+
+    The deltaLink for each list is kept in ``<filename>.delta.json``. Lists
+    without one (new lists, or the first run) are read in full.
+    """
+    previous = {}
+    links = {}
+    if os.path.exists(filename):
+        with open(filename, "r", encoding="utf-8") as f:
+            previous = {todo_list["id"]: todo_list for todo_list in json.load(f).get("value", [])}
+        if os.path.exists(delta_state_filename(filename)):
+            with open(delta_state_filename(filename), "r", encoding="utf-8") as f:
+                links = json.load(f)
+
+    lists = fetch_list_envelope(access_token)
+    if lists is None:
+        return
+
+    def refresh(todo_list):
+        old = previous.get(todo_list["id"])
+        link = links.get(todo_list["id"]) if old is not None else None
+        result = fetch_task_changes(access_token, todo_list["id"], link)
+        if result is None:
+            # Keep what we had and retry from the same point next run.
+            return (old or {}).get("tasks", []), link, 0, 0
+        changed, removed, next_link, full = result
+        if not full:
+            return merge_tasks(old.get("tasks", []), changed, removed), next_link, len(changed), len(removed)
+        # A full listing replaces the old tasks; whatever it lacks was deleted.
+        kept = {task["id"] for task in changed}
+        gone = sum(1 for task in (old or {}).get("tasks", []) if task["id"] not in kept)
+        return changed, next_link, len(changed), gone
+
+    todo_lists = lists.get("value", [])
+    new_links = {}
+    total_changed = total_removed = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for todo_list, (tasks, link, changed, removed) in zip(todo_lists, pool.map(refresh, todo_lists)):
+            todo_list["tasks"] = tasks
+            if link:
+                new_links[todo_list["id"]] = link
+            total_changed += changed
+            total_removed += removed
+
+    # Write the export before the links: if we stop in between, the next
+    # run replays the same changes, which merge_tasks applies idempotently.
+    export_to_json(lists, filename)
+    with open(delta_state_filename(filename), "w", encoding="utf-8") as f:
+        json.dump(new_links, f, indent=4)
+    print(f"Incremental export: {total_changed} tasks added or changed, {total_removed} removed")
 
 def export_to_json(data, filename):
     with open(filename, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4)
     print(f"Data exported to {filename}")
 
-def import_from_json(access_token, filename):
-    with open(filename, "r", encoding="utf-8") as f:
-        todo_data = json.load(f)
+def export_to_ndjson(access_token, filename, concurrency=DEFAULT_CONCURRENCY):
+    """Stream every list and task to a line-delimited export as pages arrive.
+
+    Lists are fetched in parallel, but each list's records are written as a
+    block in list order. A list may buffer only a few pages ahead of the
+    writer, so memory does not grow with the size of the account. The
+    offset of each block goes to the export's index.
+    """
+    lists = fetch_list_envelope(access_token)
+    if lists is None:
+        return
+    todo_lists = lists.pop("value", [])
+    pages = [queue.Queue(maxsize=PAGES_IN_FLIGHT) for _ in todo_lists]
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def produce(index):
+        list_id = todo_lists[index]["id"]
+        try:
+            for page in get_client(access_token).iter_pages(f"/me/todo/lists/{list_id}/tasks"):
+                put(pages[index], page.get("value", []))
+        except GraphError as e:
+            print(f"Error fetching tasks for list {list_id}: {e}")
+        finally:
+            put(pages[index], None)
+
+    task_count = 0
+    index = []
+    with open(filename, "w", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        try:
+            producers = [pool.submit(produce, i) for i in range(len(todo_lists))]
+            write_record(f, "header", lists)
+            for todo_list, list_pages in zip(todo_lists, pages):
+                entry = {"id": todo_list["id"], "displayName": todo_list.get("displayName"),
+                         "offset": f.tell(), "tasks": 0}
+                write_record(f, "list", todo_list)
+                while (tasks := list_pages.get()) is not None:
+                    for task in tasks:
+                        write_record(f, "task", task, list_id=todo_list["id"])
+                    entry["tasks"] += len(tasks)
+                task_count += entry["tasks"]
+                index.append(entry)
+            # A producer that failed still ended its list, so the block above
+            # may be short; fail the export rather than index it as complete.
+            for producer in producers:
+                producer.result()
+        finally:
+            stop.set()
+    write_index(filename, index)
+    print(f"Data exported to {filename} ({len(todo_lists)} lists, {task_count} tasks)")
+
+def import_from_json(access_token, filename, resume=False, lists=None):
+    """Import a .json or line-delimited export.
+
+    Records are read one at a time and each list's tasks are queued as soon
+    as they are read, so a line-delimited export is never held in memory.
+    ``lists`` restricts the import to the lists with these names or ids;
+    an indexed export then reads only their part of the file.
+    Everything created is journaled in ``<filename>.journal.db``; with
+    ``resume`` the lists and tasks already in the journal are skipped.
+    """
+    writer = BatchWriter(get_client(access_token))
+    journal = ImportJournal(f"{filename}.journal.db", resume)
+    # Source list id -> id of the list created for it
+    target_ids = {}
     
-    url = "https://graph.microsoft.com/v1.0/me/todo/lists"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    for record in iter_records(filename, lists):
+        if record["type"] == "list":
+            todo_list = record["data"]
+            existing = journal.target("list", todo_list["id"])
+            if existing:
+                target_ids[todo_list["id"]] = existing
+                continue
+            import_list(writer, todo_list, target_ids, journal)
+            # Create the list right away so its tasks, which follow it in
+            # the file, can be queued as they are read.
+            writer.flush()
+        elif record["type"] == "task" and record["list_id"] in target_ids:
+            list_id = target_ids[record["list_id"]]
+            if journal.target(task_kind(list_id), record["data"]["id"]):
+                continue
+            import_task(writer, list_id, record["data"], journal)
+    writer.flush()
+    journal.close()
+    print_batch_summary(writer)
+    if resume:
+        print(f"Skipped {journal.skipped} lists and tasks imported by an earlier run")
+
+def import_list(writer, todo_list, target_ids, journal):
+    """Queue the creation of a list and record its new id in ``target_ids``."""
+    list_name = todo_list["displayName"]
     
-    for todo_list in todo_data.get("value", []):
-        list_name = todo_list["displayName"]
-        payload = {"displayName": list_name}
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 201:
-            new_list_id = response.json()["id"]
+    def created(status, body):
+        if status == 201:
             print(f"Imported list: {list_name}")
-            
-            for task in todo_list.get("tasks", []):
-                import_task(access_token, new_list_id, task)
+            target_ids[todo_list["id"]] = body["id"]
+            journal.record("list", todo_list["id"], body["id"])
         else:
-            print(f"Error importing {list_name}: {response.status_code}, {response.text}")
+            print(f"Error importing {list_name}: {status}, {json.dumps(body)}")
+    
+    writer.add("POST", "/me/todo/lists", {"displayName": list_name}, callback=created)
 
-def import_task(access_token, list_id, task):
-    url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+def import_task(writer, list_id, task, journal):
+    """Queue the creation of ``task`` in ``list_id`` on the batch writer."""
     payload = {
         "title": task["title"],
         "status": task.get("status", "notStarted"),
         "dueDateTime": task.get("dueDateTime"),
         "body": {"content": task.get("body", {}).get("content", ""), "contentType": "text"}
     }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 201:
-        print(f"Imported task: {task['title']}")
-    else:
-        print(f"Error importing task {task['title']}: {response.status_code}, {response.text}")
+
+    def created(status, body):
+        if status == 201:
+            print(f"Imported task: {task['title']}")
+            journal.record(task_kind(list_id), task["id"], body["id"])
+        else:
+            print(f"Error importing task {task['title']}: {status}, {json.dumps(body)}")
+
+    writer.add("POST", f"/me/todo/lists/{list_id}/tasks", payload, callback=created)
+
+def print_batch_summary(writer):
+    print(f"Sent {writer.requests_sent} batch requests for {writer.succeeded + writer.failed} items "
+          f"({writer.failed} failed)")
 
 def main():
     parser = argparse.ArgumentParser(description="Export or import Microsoft To-Do lists and tasks.")
     parser.add_argument("action", choices=["export", "import"], help="Action to perform: export or import")
-    parser.add_argument("filename", help="Filename to export to or import from")
+    parser.add_argument("filename", help="Filename to export to or import from (.ndjson/.jsonl for line-delimited records)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Number of lists to fetch at once during export (default {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Export only tasks changed since the last run and merge them into the file")
+    parser.add_argument("--resume", action="store_true",
+                        help="Import: skip lists and tasks an earlier, interrupted import already created")
+    parser.add_argument("--lists",
+                        help="Import: comma-separated names or ids of the lists to import (default all)")
     args = parser.parse_args()
     
     token = get_access_token()
+    # Size the connection pool so every worker keeps its own connection.
+    get_client(token, pool_size=max(args.concurrency, DEFAULT_POOL_SIZE))
     
-    if args.action == "export":
-        todo_data = fetch_todo_lists(token)
+    if args.action == "export" and args.incremental:
+        if is_ndjson_name(args.filename):
+            print("Error: --incremental works on .json exports only.")
+            return
+        with metrics.time("phase", "export_incremental"):
+            export_incremental(token, args.filename, args.concurrency)
+    elif args.action == "export" and is_ndjson_name(args.filename):
+        with metrics.time("phase", "export"):
+            export_to_ndjson(token, args.filename, args.concurrency)
+    elif args.action == "export":
+        with metrics.time("phase", "fetch"):
+            todo_data = fetch_todo_lists(token, args.concurrency)
         if todo_data:
-            export_to_json(todo_data, args.filename)
+            with metrics.time("phase", "write"):
+                export_to_json(todo_data, args.filename)
     elif args.action == "import":
-        import_from_json(token, args.filename)
+        with metrics.time("phase", "import"):
+            lists = [name.strip() for name in args.lists.split(",")] if args.lists else None
+            import_from_json(token, args.filename, args.resume, lists)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,11 @@
-import requests
 import json
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from graph_client import GraphError, get_client
+from graph_metrics import metrics
 
 def get_access_token():
     try:
@@ -10,48 +15,45 @@ def get_access_token():
         print("Error: Token file 'token.txt' not found. Please create the file and add your OAuth2 token.")
         exit(1)
 
+def iter_tasks(access_token, list_id):
+    """Yield the tasks of a list page by page as they arrive."""
+    try:
+        yield from get_client(access_token).iter_items(f"/me/todo/lists/{list_id}/tasks")
+    except GraphError as e:
+        print(f"Error fetching tasks for list {list_id}: {e}")
+
 def fetch_tasks(access_token, list_id):
-    url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json().get("value", [])
-    else:
-        print(f"Error fetching tasks for list {list_id}: {response.status_code}, {response.text}")
-        return []
+    return list(iter_tasks(access_token, list_id))
 
 def update_task_status(access_token, task_id, list_id):
-    url = f"https://graph.microsoft.com/v1.0/me/todo/lists/{list_id}/tasks/{task_id}"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     payload = {"status": "notStarted"}
-    response = requests.patch(url, headers=headers, json=payload)
+    response = get_client(access_token).patch(f"/me/todo/lists/{list_id}/tasks/{task_id}", json=payload)
     if response.status_code == 200:
         print(f"Updated task {task_id} to 'notStarted'")
     else:
         print(f"Error updating task {task_id}: {response.status_code}, {response.text}")
 
 def reset_list_tasks(access_token, list_name):
-    url = "https://graph.microsoft.com/v1.0/me/todo/lists"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"Error fetching lists: {response.status_code}, {response.text}")
-        return
-    
-    lists = response.json().get("value", [])
     list_id = None
-    for todo_list in lists:
-        if todo_list["displayName"] == list_name:
-            list_id = todo_list["id"]
-            break
+    try:
+        with metrics.time("phase", "fetch"):
+            # Stop paging as soon as the list turns up.
+            for todo_list in get_client(access_token).iter_items("/me/todo/lists"):
+                if todo_list["displayName"] == list_name:
+                    list_id = todo_list["id"]
+                    break
+    except GraphError as e:
+        print(f"Error fetching lists: {e}")
+        return
     
     if not list_id:
         print(f"Error: List '{list_name}' not found.")
         return
     
-    tasks = fetch_tasks(access_token, list_id)
-    for task in tasks:
-        update_task_status(access_token, task["id"], list_id)
+    # Tasks are updated as each page is read, without collecting the list first.
+    with metrics.time("phase", "update"):
+        for task in iter_tasks(access_token, list_id):
+            update_task_status(access_token, task["id"], list_id)
 
 def main():
     parser = argparse.ArgumentParser(description="Reset all tasks in a Microsoft To-Do list to 'Not Completed'")